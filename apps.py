@@ -4,3 +4,6 @@ from django.apps import AppConfig
 class ErvinloadsConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'ervinloads'
+
+    def ready(self):
+        from . import signals
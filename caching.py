@@ -0,0 +1,157 @@
+import hashlib
+from django.core.cache import cache
+from django.core.paginator import Paginator
+from django.db.models.functions import Upper
+from django.utils.functional import cached_property
+
+from .conf import get_setting
+from .models import CompletionStatus, DeliveryStatus, Location, NotificationGroup, Supplier
+
+CACHE_PREFIX = 'ervinloads'
+
+def get_cache_timeout(name, default):
+    return get_setting(f'{ name.upper() }_CACHE_TIMEOUT', default)
+
+def version_key(name):
+    return f'{ CACHE_PREFIX }:version:{ name }'
+
+def get_version(name):
+    version = cache.get(version_key(name))
+    if version is None:
+        cache.add(version_key(name), 1, None)
+        version = cache.get(version_key(name), 1)
+    return version
+
+def bump_version(name):
+    try:
+        cache.incr(version_key(name))
+    except ValueError:
+        cache.add(version_key(name), 2, None)
+
+def get_versions(names):
+    # Like get_version for many names with one cache read. Missing versions
+    # are 1, as bump_version starts them at 2
+    versions = cache.get_many([version_key(name) for name in names])
+    return {name: versions.get(version_key(name), 1) for name in names}
+
+def queryset_key(queryset):
+    # Keyed on the filtering only, so vistas that differ by their ordering or
+    # shown columns share a count
+    sql, params = queryset.order_by().values('pk').query.sql_with_params()
+    return hashlib.md5(f'{ sql }{ params }'.encode()).hexdigest()
+
+def cached_count(queryset):
+    key = f'{ CACHE_PREFIX }:count:{ get_version("counts") }:{ queryset_key(queryset) }'
+    count = cache.get(key)
+    if count is None:
+        count = queryset.count()
+        cache.set(key, count, get_cache_timeout('count', 300))
+    return count
+
+class CachedCountPaginator(Paginator):
+
+    @cached_property
+    def count(self):
+        if hasattr(self.object_list, 'query'):
+            return cached_count(self.object_list)
+        return super().count
+
+def cached_notification_count(queryset, tag):
+    # The count of notifications waiting in the queue page, recounted only
+    # when the tag from notifications.notification_count_tag changes
+    key = f'{ CACHE_PREFIX }:notification_count:{ tag }'
+    count = cache.get(key)
+    if count is None:
+        count = queryset.count()
+        cache.set(key, count, get_cache_timeout('notification_count', 3600))
+    return count
+
+# Lookup tables that are read far more often than they change, and the fields
+# kept for each row. Suppliers are too many to keep whole, and are looked up
+# with the autocomplete and by pk instead
+REFERENCE_FIELDS = {
+    DeliveryStatus: ['pk', 'name', 'rank', 'is_active', 'is_default'],
+    CompletionStatus: ['pk', 'name', 'rank', 'is_active', 'is_default'],
+    Location: ['pk', 'name', 'is_default'],
+    NotificationGroup: ['pk', 'name', 'is_default'],
+}
+
+# Lookup tables whose names are shown in load rows or offered by autocomplete
+LOOKUP_MODELS = [DeliveryStatus, CompletionStatus, Location, NotificationGroup, Supplier]
+
+def lookup_version_name(model):
+    return f'lookup:{ model._meta.label }'
+
+# (version, data, index), replaced as a whole so a thread never sees the data
+# of one version with the index of another
+_reference_data = (None, None, None)
+
+def get_reference_snapshot():
+    # Kept in process memory until the shared "reference" version changes, so a
+    # warm process only reads the version from the cache
+    global _reference_data
+    version = get_version('reference')
+    snapshot = _reference_data
+    if snapshot[0] != version:
+        key = f'{ CACHE_PREFIX }:reference:{ version }'
+        data = cache.get(key)
+        if data is None:
+            data = {
+                model._meta.label: list(model.objects.values(*fields))
+                for model, fields in REFERENCE_FIELDS.items()
+            }
+            cache.set(key, data, get_cache_timeout('reference', None))
+        index = {label: {str(row['pk']): row for row in rows} for label, rows in data.items()}
+        snapshot = (version, data, index)
+        _reference_data = snapshot
+    return snapshot
+
+def get_reference_data():
+    return get_reference_snapshot()[1]
+
+def reference_rows(model):
+    return get_reference_data()[model._meta.label]
+
+def reference_row(model, pk):
+    return get_reference_snapshot()[2][model._meta.label].get(str(pk))
+
+def default_pks(model):
+    return [row['pk'] for row in reference_rows(model) if row['is_default']]
+
+def default_pk(model):
+    pks = default_pks(model)
+    return pks[0] if pks else None
+
+def cached_autocomplete(queryset, term, limit):
+    # Names starting with the term first, then names containing it, cached
+    # until the table they come from changes
+    term_key = hashlib.md5(term.lower().encode()).hexdigest()
+    key = f'{ CACHE_PREFIX }:autocomplete:{ get_version(lookup_version_name(queryset.model)) }:{ queryset.model._meta.label }:{ limit }:{ term_key }'
+    results = cache.get(key)
+    if results is None:
+        # A range on Upper('name') can be read from the uname index on any
+        # backend, where istartswith is a LIKE that scans the table
+        prefix = term.upper()
+        starting = queryset.annotate(uname=Upper('name')).filter(
+            uname__gte=prefix, uname__lt=prefix + '\U0010ffff', uname__startswith=prefix
+        )
+        results = list(starting.order_by('uname').values('pk', 'name')[:limit])
+        if term and len(results) < limit:
+            results += list(
+                queryset.filter(name__icontains=term).exclude(pk__in=[row['pk'] for row in results])
+                .order_by('name').values('pk', 'name')[:limit - len(results)]
+            )
+        results = [{'id': row['pk'], 'text': row['name']} for row in results]
+        cache.set(key, results, get_cache_timeout('autocomplete', 3600))
+    return results
+
+def row_cache_key(show_columns):
+    # The part of a list row's fragment cache key shared by every row: the
+    # version of the lookup names rows show, and the columns shown
+    return f'{ get_version("lookup_names") }:{ ",".join(show_columns) }'
+
+def set_row_versions(loads):
+    # Sets row_version on each load, which the load's post_save signal bumps
+    versions = get_versions([f'load_row:{ load.pk }' for load in loads])
+    for load in loads:
+        load.row_version = versions[f'load_row:{ load.pk }']
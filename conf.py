@@ -0,0 +1,6 @@
+from django.conf import settings
+
+
+def get_setting(name, default):
+    # The project's ERVINLOADS_<name> setting, or default if it isn't set
+    return getattr(settings, f'ERVINLOADS_{ name }', default)
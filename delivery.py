@@ -0,0 +1,107 @@
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from django.core.mail import get_connection
+
+from .conf import get_setting
+
+DeliveryResult = namedtuple('DeliveryResult', ['message', 'sent', 'error'])
+
+
+class RateLimiter:
+    # Spaces calls to wait() at least 1/rate seconds apart across threads
+
+    def __init__(self, rate):
+        self.interval = 1 / rate
+        self.next_time = time.monotonic()
+        self.lock = threading.Lock()
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            slot = max(now, self.next_time)
+            self.next_time = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
+class DeliveryPool:
+    # Sends messages on a bounded number of threads, each keeping one mail
+    # connection open for all of its messages. Sending can be limited to
+    # ERVINLOADS_DELIVERY_RATE messages a second overall and to
+    # ERVINLOADS_DELIVERY_DOMAIN_RATE a second for each recipient domain.
+    # send() reports a DeliveryResult for every message instead of raising.
+    # Given a connection, the pool sends every message over it in turn and
+    # leaves it open, so a caller can use one connection for many sends
+
+    def __init__(self, workers=None, rate=None, domain_rate=None, connection=None):
+        self.workers = workers or get_setting('DELIVERY_WORKERS', 4)
+        self.connection = connection
+        self.reopen = False
+        rate = rate or get_setting('DELIVERY_RATE', None)
+        self.limiter = RateLimiter(rate) if rate else None
+        self.domain_rate = domain_rate or get_setting('DELIVERY_DOMAIN_RATE', None)
+        self.domain_limiters = {}
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.connections = []
+
+    def get_domain_limiter(self, domain):
+        with self.lock:
+            if not domain in self.domain_limiters:
+                self.domain_limiters[domain] = RateLimiter(self.domain_rate)
+            return self.domain_limiters[domain]
+
+    def get_connection(self):
+        if self.connection is not None:
+            if self.reopen:
+                self.connection.open()
+                self.reopen = False
+            return self.connection
+
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            connection = get_connection(fail_silently=False)
+            connection.open()
+            self.local.connection = connection
+            with self.lock:
+                self.connections.append(connection)
+        return connection
+
+    def send_message(self, message):
+        if self.limiter:
+            self.limiter.wait()
+        if self.domain_rate:
+            for domain in sorted({recipient.rsplit('@', 1)[-1].lower() for recipient in message.recipients()}):
+                self.get_domain_limiter(domain).wait()
+
+        try:
+            self.get_connection().send_messages([message])
+        except Exception as e:
+            # The connection may be broken, so the next message opens a new one
+            if self.connection is not None:
+                self.connection.close()
+                self.reopen = True
+            self.local.connection = None
+            return DeliveryResult(message, False, e)
+
+        return DeliveryResult(message, True, None)
+
+    def send(self, messages):
+        if not messages:
+            return []
+
+        if self.connection is not None:
+            return [self.send_message(message) for message in messages]
+
+        try:
+            with ThreadPoolExecutor(max_workers=min(self.workers, len(messages)), thread_name_prefix='ervinloads-delivery') as executor:
+                return list(executor.map(self.send_message, messages))
+        finally:
+            for connection in self.connections:
+                try:
+                    connection.close()
+                except Exception:
+                    pass
+            self.connections = []
@@ -0,0 +1,115 @@
+import csv
+import tempfile
+from datetime import datetime
+from django.db import models
+from django.http import FileResponse, StreamingHttpResponse
+
+from .conf import get_setting
+from .models import Load
+from .templatetags.ervinloads_tags import load_list_columns
+
+try:
+    import openpyxl
+    from openpyxl.cell import WriteOnlyCell
+    from openpyxl.cell.cell import ILLEGAL_CHARACTERS_RE
+except ImportError:
+    openpyxl = None
+
+EXPORT_FORMATS = ['csv', 'xlsx']
+
+# A spreadsheet reads a cell starting with one of these as a formula
+FORMULA_PREFIXES = ('=', '+', '-', '@', '\t', '\r')
+
+def get_chunk_size():
+    return get_setting('EXPORT_CHUNK_SIZE', 2000)
+
+def export_formats():
+    return [export_format for export_format in EXPORT_FORMATS if export_format != 'xlsx' or openpyxl is not None]
+
+def export_columns(show_columns):
+    # The load list's shown columns, in list order
+    return [column for column, cell in load_list_columns(show_columns)]
+
+def export_value(load, column):
+    # Written as the list shows it: choices and related rows by their display
+    # text, and files by name
+    field = Load._meta.get_field(column)
+    if field.choices:
+        return getattr(load, f'get_{ column }_display')()
+    value = getattr(load, column)
+    if field.is_relation:
+        return str(value) if value is not None else ''
+    if isinstance(field, models.FileField):
+        return value.name if value else ''
+    return value
+
+def escape_formula(value):
+    # Text typed into a load, such as =HYPERLINK(...), must open as text rather
+    # than run in whoever opens the CSV export
+    if isinstance(value, str) and value.startswith(FORMULA_PREFIXES):
+        return "'" + value
+    return value
+
+def export_rows(queryset, columns):
+    # Rows are fetched chunk_size at a time with a server side cursor where the
+    # database has one, so memory doesn't grow with the number of loads
+    for load in queryset.iterator(chunk_size=get_chunk_size()):
+        yield [export_value(load, column) for column in columns]
+
+def export_filename(extension):
+    return f'loads-{ datetime.now().strftime("%Y%m%d-%H%M%S") }.{ extension }'
+
+class Echo:
+    # A file-like object whose write() returns what it's given, so csv.writer
+    # produces lines for a streaming response
+
+    def write(self, value):
+        return value
+
+def csv_lines(queryset, columns, labels):
+    writer = csv.writer(Echo())
+    yield writer.writerow([labels.get(column, column) for column in columns])
+    for row in export_rows(queryset, columns):
+        yield writer.writerow([escape_formula(value) for value in row])
+
+def csv_response(queryset, columns, labels):
+    response = StreamingHttpResponse(csv_lines(queryset, columns, labels), content_type='text/csv')
+    response['Content-Disposition'] = f'attachment; filename="{ export_filename("csv") }"'
+    return response
+
+def xlsx_value(worksheet, value):
+    # Text is written as a string cell, as openpyxl would otherwise store text
+    # starting with = as a formula
+    if isinstance(value, str):
+        cell = WriteOnlyCell(worksheet, ILLEGAL_CHARACTERS_RE.sub('', value))
+        cell.data_type = 's'
+        return cell
+    return value
+
+def xlsx_response(queryset, columns, labels):
+    # openpyxl's write only mode keeps just the current row in memory. An xlsx
+    # file is a zip that can't be sent until it's finished, so it's written to
+    # a temporary file and streamed from there
+    workbook = openpyxl.Workbook(write_only=True)
+    worksheet = workbook.create_sheet('Loads')
+    worksheet.append([labels.get(column, column) for column in columns])
+    for row in export_rows(queryset, columns):
+        worksheet.append([xlsx_value(worksheet, value) for value in row])
+
+    file = tempfile.TemporaryFile()
+    workbook.save(file)
+    file.seek(0)
+
+    return FileResponse(
+        file,
+        as_attachment=True,
+        filename=export_filename('xlsx'),
+        content_type='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+    )
+
+def export_response(queryset, show_columns, labels, export_format):
+    columns = export_columns(show_columns)
+    labels = {column: str(label) for column, label in (labels or {}).items()}
+    if export_format == 'xlsx':
+        return xlsx_response(queryset, columns, labels)
+    return csv_response(queryset, columns, labels)
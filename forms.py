@@ -1,6 +1,140 @@
 from django import forms
+from django.core.exceptions import ValidationError
+from django.core.files.uploadedfile import UploadedFile
 from django.forms import inlineformset_factory
+from django.forms.models import ModelChoiceIterator
+from django.urls import reverse_lazy
+from .caching import REFERENCE_FIELDS, reference_row, reference_rows
 from .models import Load, Location, Notification, Supplier
+from .notifications import NOTIFICATION_RELATED, review_filter
+from .photos import process_upload
+
+class CachedModelChoiceIterator(ModelChoiceIterator):
+    # Yields the choices from the cached lookup rows instead of the queryset
+
+    def rows(self):
+        return reference_rows(self.queryset.model)
+
+    def __iter__(self):
+        if not self.field.use_cache():
+            yield from super().__iter__()
+            return
+        if self.field.empty_label is not None:
+            yield ('', self.field.empty_label)
+        for row in self.rows():
+            yield (row['pk'], row['name'])
+
+    def __len__(self):
+        if not self.field.use_cache():
+            return super().__len__()
+        return len(self.rows()) + (1 if self.field.empty_label is not None else 0)
+
+    def __bool__(self):
+        if not self.field.use_cache():
+            return super().__bool__()
+        return self.field.empty_label is not None or bool(self.rows())
+
+    def selected(self, values):
+        # The choices for the given values only, looked up directly rather
+        # than found by walking every choice
+        choices = [('', self.field.empty_label)] if self.field.empty_label is not None else []
+        if self.field.use_cache():
+            rows = [reference_row(self.queryset.model, value) for value in values]
+            if None not in rows:
+                return choices + [(row['pk'], row['name']) for row in rows]
+        key = self.field.to_field_name or 'pk'
+        try:
+            return choices + [self.choice(obj) for obj in self.queryset.filter(**{f'{ key }__in': values})]
+        except (ValueError, TypeError, ValidationError):
+            return choices
+
+class CachedChoiceMixin:
+    # Renders and validates the choices of a lookup model from the cached
+    # lookup rows (see caching.REFERENCE_FIELDS). A submitted pk becomes an
+    # instance holding the cached fields, with the rest deferred. Models that
+    # aren't cached, filtered querysets and pks missing from the cache go to
+    # the database as usual
+
+    iterator = CachedModelChoiceIterator
+
+    def use_cache(self):
+        model = self.queryset.model
+        return (
+            model in REFERENCE_FIELDS and self.to_field_name in (None, model._meta.pk.name)
+            and not self.queryset.query.has_filters()
+        )
+
+    def cached_instance(self, pk):
+        model = self.queryset.model
+        row = reference_row(model, pk)
+        if row is None:
+            return None
+        row = {model._meta.pk.attname if name == 'pk' else name: value for name, value in row.items()}
+        field_names = [field.attname for field in model._meta.concrete_fields if field.attname in row]
+        return model.from_db(self.queryset.db, field_names, [row[name] for name in field_names])
+
+class CachedModelChoiceField(CachedChoiceMixin, forms.ModelChoiceField):
+
+    def to_python(self, value):
+        if value in self.empty_values or not self.use_cache():
+            return super().to_python(value)
+        if isinstance(value, self.queryset.model):
+            value = value.pk
+        instance = self.cached_instance(value)
+        if instance is None:
+            return super().to_python(value)
+        return instance
+
+class CachedModelMultipleChoiceField(CachedChoiceMixin, forms.ModelMultipleChoiceField):
+
+    def _check_values(self, value):
+        if not self.use_cache():
+            return super()._check_values(value)
+        try:
+            value = frozenset(value)
+        except TypeError:
+            raise ValidationError(self.error_messages['invalid_list'], code='invalid_list')
+        instances = [self.cached_instance(pk) for pk in value]
+        if None in instances:
+            return super()._check_values(value)
+        return instances
+
+class AutocompleteSelect(forms.Select):
+    # Renders only the selected option, with a search box that fills the select
+    # from a JSON autocomplete url. The select keeps its id so popups that add
+    # options to it still work
+
+    class Media:
+        js = ['ervinloads/autocomplete.js']
+
+    def __init__(self, url, attrs=None):
+        super().__init__(attrs)
+        self.url = url
+
+    def get_context(self, name, value, attrs):
+        attrs = {**(attrs or {}), 'data-autocomplete-url': str(self.url)}
+        return super().get_context(name, value, attrs)
+
+    def optgroups(self, name, value, attrs=None):
+        selected = [item for item in value if item not in (None, '')]
+        choices = self.choices
+        if isinstance(choices, CachedModelChoiceIterator):
+            self.choices = choices.selected(selected)
+        else:
+            selected = {str(item) for item in selected}
+            self.choices = [choice for choice in choices if choice[0] == '' or str(choice[0]) in selected]
+        try:
+            return super().optgroups(name, value, attrs)
+        finally:
+            self.choices = choices
+
+class LoadLocationForm(forms.ModelForm):
+    # A load's location on its own, for recording a move with update_history
+
+    class Meta:
+        model = Load
+        fields = ['location']
+        field_classes = {'location': CachedModelChoiceField}
 
 class LoadForm(forms.ModelForm):
 
@@ -23,8 +157,29 @@ class LoadForm(forms.ModelForm):
             'completion_status',
         ]
         widgets = {
+            'supplier': AutocompleteSelect(reverse_lazy('ervinloads:supplier-autocomplete')),
+            'location': AutocompleteSelect(reverse_lazy('ervinloads:location-autocomplete')),
+        }
+        field_classes = {
+            'supplier': CachedModelChoiceField,
+            'location': CachedModelChoiceField,
+            'delivery_status': CachedModelChoiceField,
+            'completion_status': CachedModelChoiceField,
+            'notification_groups': CachedModelMultipleChoiceField,
         }
 
+    def clean_photo(self):
+        photo = self.cleaned_data.get('photo')
+        if isinstance(photo, UploadedFile):
+            self.instance.photo_original_size = photo.size
+            try:
+                return process_upload(photo)
+            except Exception:
+                raise ValidationError('The photo could not be processed')
+        if not photo:
+            self.instance.photo_original_size = None
+        return photo
+
 class LocationForm(forms.ModelForm):
     class Meta:
         model = Location
@@ -45,9 +200,15 @@ class LocationMergeForm(forms.Form):
         print('tp 2253e59', self.initial)
         return init
 
-    merge_from=forms.ModelChoiceField(Location.objects.all())
+    merge_from=forms.ModelMultipleChoiceField(Location.objects.all())
     merge_to=forms.ModelChoiceField(Location.objects.all())
 
+    def clean(self):
+        cleaned_data = super().clean()
+        if cleaned_data.get('merge_to') and cleaned_data.get('merge_to') in cleaned_data.get('merge_from', []):
+            raise ValidationError('Merge From and Merge To cannot be the same')
+        return cleaned_data
+
 class NotificationForm(forms.ModelForm):
     class Meta:
         model = Notification
@@ -55,10 +216,36 @@ class NotificationForm(forms.ModelForm):
             'load',
             'created_when',
         ]
+class NotificationChoiceField(forms.ModelMultipleChoiceField):
+    # Validates the selection with one pk__in query and returns the
+    # notifications ready to be sent, rather than a queryset to be run again
+
+    def clean(self, value):
+        value = self.prepare_value(value)
+        if not value:
+            if self.required:
+                raise ValidationError(self.error_messages['required'], code='required')
+            return []
+        if not isinstance(value, (list, tuple)):
+            raise ValidationError(self.error_messages['invalid_list'], code='invalid_list')
+
+        try:
+            pks = {int(pk) for pk in value}
+        except (TypeError, ValueError):
+            raise ValidationError(self.error_messages['invalid_pk_value'], code='invalid_pk_value', params={'pk': value})
+
+        notifications = list(self.queryset.filter(pk__in=pks).select_related(*NOTIFICATION_RELATED).order_by('pk'))
+        missing = pks - {notification.pk for notification in notifications}
+        if missing:
+            raise ValidationError(self.error_messages['invalid_choice'], code='invalid_choice', params={'value': min(missing)})
+
+        self.run_validators(value)
+        return notifications
+
 class NotificationSendForm(forms.Form):
 
-    notifications = forms.ModelMultipleChoiceField(
-        queryset = Notification.objects.all(),
+    notifications = NotificationChoiceField(
+        queryset = Notification.objects.none(),
         widget = forms.CheckboxSelectMultiple
     )
     operation = forms.ChoiceField(
@@ -67,3 +254,9 @@ class NotificationSendForm(forms.Form):
         initial = 'ss'
     )
 
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Overdue queued notifications depend on the time, so this is filtered
+        # per form rather than once at import
+        self.fields['notifications'].queryset = Notification.objects.filter(review_filter())
+
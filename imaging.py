@@ -0,0 +1,51 @@
+import io
+import os
+from PIL import Image, ImageOps
+
+# Pure Pillow functions run in the photo process pool. They take and return
+# bytes and must not import Django, so a worker process can import them
+# without setting Django up
+
+def open_image(data, size):
+    return open_image_file(Image.open(io.BytesIO(data)), size)
+
+def open_image_file(image, size):
+    # Lets JPEGs decode at a reduced scale that is still at least size
+    image.draft('RGB', (size, size))
+    return ImageOps.exif_transpose(image)
+
+def encode_image(image, image_format, quality):
+    if image_format == 'JPEG' and image.mode != 'RGB':
+        image = image.convert('RGB')
+    elif image.mode not in ('RGB', 'RGBA'):
+        image = image.convert('RGBA' if 'transparency' in image.info or image.mode in ('LA', 'PA') else 'RGB')
+    output = io.BytesIO()
+    image.save(output, image_format, quality=quality)
+    return output.getvalue()
+
+def render_thumbnails(data, sizes, image_format, quality):
+    # Returns the encoded thumbnail for each of sizes, a list of maximum widths
+    # and heights
+    image = open_image(data, max(sizes))
+    thumbnails = []
+    for size in sizes:
+        thumbnail = image.copy()
+        thumbnail.thumbnail((size, size), Image.LANCZOS)
+        thumbnails.append(encode_image(thumbnail, image_format, quality))
+    return thumbnails
+
+def downscale_photo(source, max_size, quality):
+    # Caps an uploaded photo at max_size pixels wide and high, applies its EXIF
+    # orientation and recompresses it. source is a file path, which Pillow
+    # reads as it decodes, or bytes. Returns (data, format), or None if the
+    # photo is no larger than max_size and recompressing wouldn't shrink it
+    source_size = os.path.getsize(source) if isinstance(source, str) else len(source)
+    with Image.open(source if isinstance(source, str) else io.BytesIO(source)) as original:
+        original_dimensions = original.size
+        image = open_image_file(original, max_size)
+        image.thumbnail((max_size, max_size), Image.LANCZOS)
+    image_format = 'PNG' if image.mode in ('RGBA', 'LA', 'PA') or 'transparency' in image.info else 'JPEG'
+    data = encode_image(image, image_format, quality)
+    if max(original_dimensions) <= max_size and len(data) >= source_size:
+        return None
+    return data, image_format
@@ -0,0 +1,58 @@
+import time
+from django.core.mail import get_connection
+from django.core.management.base import BaseCommand
+
+from ervinloads.conf import get_setting
+from ervinloads.delivery import DeliveryPool
+from ervinloads.notifications import claim_notifications, deliver_digests, deliver_notifications, get_base_url
+
+
+class Command(BaseCommand):
+    help = 'Deliver queued load notifications. Safe to run on several servers at once'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=get_setting('NOTIFICATION_BATCH_SIZE', 50), help='How many notifications to claim at a time')
+        parser.add_argument('--lease', type=int, default=get_setting('NOTIFICATION_LEASE', 300), help='Seconds before an unfinished claim can be taken by another worker')
+        parser.add_argument('--base-url', default=get_base_url(), help='The site URL used for links in the messages (defaults to ERVINLOADS_BASE_URL)')
+        parser.add_argument('--digest', action='store_true', help='Send each batch as one message per recipient, spread over the delivery pool\'s connections. A failed recipient is retried without resending to the others')
+        parser.add_argument('--workers', type=int, default=None, help='With --digest, how many mail connections to send on at once (defaults to ERVINLOADS_DELIVERY_WORKERS). Without it the whole drain is sent over one connection')
+        parser.add_argument('--loop', action='store_true', help='Keep polling for notifications instead of exiting when the queue is empty')
+        parser.add_argument('--interval', type=float, default=5, help='Seconds to wait between polls with --loop')
+
+    def handle(self, *args, **options):
+
+        connection = None
+        if options['digest']:
+            pool = DeliveryPool(workers=options['workers'])
+        else:
+            connection = get_connection(fail_silently=False)
+            connection.open()
+            pool = DeliveryPool(connection=connection)
+
+        try:
+            self.drain(pool, options)
+        finally:
+            if connection is not None:
+                connection.close()
+
+    def drain(self, pool, options):
+
+        sent = 0
+        failed = 0
+
+        while True:
+            notifications = claim_notifications(options['batch_size'], options['lease'])
+
+            if options['digest']:
+                delivered = deliver_digests(notifications, options['base_url'], pool)
+            else:
+                delivered = deliver_notifications(notifications, options['base_url'], pool)
+            sent = sent + delivered
+            failed = failed + len(notifications) - delivered
+
+            if not notifications:
+                if not options['loop']:
+                    break
+                time.sleep(options['interval'])
+
+        self.stdout.write(f'{ sent } notifications sent, { failed } failed')
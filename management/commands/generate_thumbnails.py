@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand
+
+from ervinloads.models import Load
+from ervinloads.photos import generate_thumbnails
+
+
+class Command(BaseCommand):
+    help = 'Make the thumbnails of load photos that do not have them, such as photos uploaded before thumbnails were made'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--all', action='store_true', help='Remake the thumbnails of every load with a photo')
+
+    def handle(self, *args, **options):
+
+        loads = Load.all_objects.exclude(photo='').exclude(photo__isnull=True)
+        if not options['all']:
+            loads = loads.filter(photo_thumbnail__isnull=True)
+
+        count = 0
+        for pk in loads.values_list('pk', flat=True).iterator():
+            generate_thumbnails(pk)
+            count = count + 1
+
+        self.stdout.write(f'Thumbnails made for { count } loads')
@@ -0,0 +1,28 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from ervinloads.merging import merge_locations
+from ervinloads.models import Location
+
+
+class Command(BaseCommand):
+    help = 'Move the loads at one or more locations to another location and delete the emptied locations'
+
+    def add_arguments(self, parser):
+        parser.add_argument('target', type=int, help='The pk of the location to keep')
+        parser.add_argument('sources', type=int, nargs='+', help='The pks of the locations to merge into the target')
+
+    def handle(self, *args, **options):
+
+        try:
+            target = Location.objects.get(pk=options['target'])
+        except Location.DoesNotExist:
+            raise CommandError(f'Location { options["target"] } does not exist')
+
+        sources = list(Location.objects.filter(pk__in=options['sources']))
+        missing = set(options['sources']) - {source.pk for source in sources}
+        if missing:
+            raise CommandError(f'Locations { ", ".join(str(pk) for pk in sorted(missing)) } do not exist')
+
+        result = merge_locations(sources, target)
+
+        self.stdout.write(f'{ result["loads"] } loads moved from { result["locations"] } locations to { target }')
@@ -0,0 +1,36 @@
+from django.db import transaction
+from tougshire_history.views import update_history
+
+from .caching import bump_version
+from .forms import LoadLocationForm
+from .models import Load, Location
+
+
+def merge_locations(sources, target, user=None):
+    # Moves the loads at each source location to the target and deletes the
+    # sources, all in one transaction, and records the move in each load's
+    # history. Returns the number of loads moved and locations deleted
+
+    source_pks = [source.pk for source in sources if source.pk != target.pk]
+
+    with transaction.atomic():
+        source_pks = list(Location.objects.select_for_update().filter(pk__in=source_pks).values_list('pk', flat=True))
+
+        # Soft deleted loads are moved too, so they don't lose their location
+        loads = Load.all_objects.filter(location__in=source_pks)
+        moved_loads = list(loads)
+
+        # Recorded with update_history, as the load forms are, so the move
+        # shows in each load's history on its detail page
+        for load in moved_loads:
+            form = LoadLocationForm({'location': target.pk}, instance=load)
+            form.is_valid()
+            update_history(form, 'ervinloads', 'load', load, user)
+
+        loads.update(location=target)
+
+        Location.objects.filter(pk__in=source_pks).delete()
+
+    bump_version('counts')
+
+    return {'loads': len(moved_loads), 'locations': len(source_pks)}
@@ -0,0 +1,33 @@
+# Generated by Django 5.2.18 on 2026-10-17 15:41
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ervinloads', '0017_alter_completionstatus_options_and_more'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='load',
+            index=models.Index(condition=models.Q(('deleted_when__isnull', True)), fields=['updated_when'], name='ervinloads_load_active_upd_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='load',
+            index=models.Index(fields=['delivery_status', 'updated_when'], name='ervinloads_load_dstatus_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='load',
+            index=models.Index(fields=['completion_status', 'updated_when'], name='ervinloads_load_cstatus_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='load',
+            index=models.Index(fields=['po_number'], name='ervinloads_load_po_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='load',
+            index=models.Index(fields=['spo_number'], name='ervinloads_load_spo_idx'),
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 5.2.18 on 2026-10-17 15:42
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ervinloads', '0018_load_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='notification',
+            name='attempts',
+            field=models.PositiveIntegerField(default=0, help_text='The number of times delivery has been attempted', verbose_name='attempts'),
+        ),
+        migrations.AddField(
+            model_name='notification',
+            name='last_error',
+            field=models.TextField(blank=True, help_text='The error from the last failed delivery attempt', verbose_name='last error'),
+        ),
+        migrations.AddField(
+            model_name='notification',
+            name='next_attempt_at',
+            field=models.DateTimeField(blank=True, help_text='When delivery should next be attempted', null=True, verbose_name='next attempt at'),
+        ),
+        migrations.AddField(
+            model_name='notification',
+            name='status',
+            field=models.CharField(choices=[('pending', 'Pending'), ('queued', 'Queued for delivery'), ('failed', 'Failed')], db_index=True, default='pending', help_text='Pending notifications wait in the queue, queued notifications are delivered in the background', max_length=20, verbose_name='status'),
+        ),
+    ]
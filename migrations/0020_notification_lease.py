@@ -0,0 +1,23 @@
+# Generated by Django 5.2.18 on 2026-10-17 15:43
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ervinloads', '0019_notification_outbox'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='notification',
+            name='lease_token',
+            field=models.CharField(blank=True, db_index=True, help_text='Identifies the worker claim on this notification', max_length=32, verbose_name='lease token'),
+        ),
+        migrations.AddField(
+            model_name='notification',
+            name='leased_until',
+            field=models.DateTimeField(blank=True, help_text='When the worker delivering this notification gives up its claim on it', null=True, verbose_name='leased until'),
+        ),
+    ]
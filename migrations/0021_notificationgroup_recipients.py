@@ -0,0 +1,45 @@
+# Generated by Django 5.2.18 on 2026-10-17 15:44
+
+import re
+
+from django.core.exceptions import ValidationError
+from django.core.validators import validate_email
+from django.db import migrations, models
+
+
+# A copy of models.parse_email_addresses as it was when this migration was
+# written, so later changes to it don't change what this migration does
+def valid_email_addresses(email_addresses):
+    valid = []
+    emails = dict.fromkeys(email.strip().lower() for email in re.split(r",|;", email_addresses))
+    emails.pop('', None)
+    for email in emails:
+        try:
+            validate_email(email)
+            valid.append(email)
+        except ValidationError:
+            pass
+    return valid
+
+
+def set_recipients(apps, schema_editor):
+    NotificationGroup = apps.get_model('ervinloads', 'NotificationGroup')
+    for notification_group in NotificationGroup.objects.all():
+        notification_group.recipients = valid_email_addresses(notification_group.email_addresses)
+        notification_group.save(update_fields=['recipients'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ervinloads', '0020_notification_lease'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='notificationgroup',
+            name='recipients',
+            field=models.JSONField(default=list, editable=False, help_text='The valid, normalized addresses from email addresses', verbose_name='recipients'),
+        ),
+        migrations.RunPython(set_recipients, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-17 15:47
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ervinloads', '0021_notificationgroup_recipients'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='notification',
+            name='changed_fields',
+            field=models.JSONField(blank=True, default=list, help_text='The load fields changed by the updates this notification reports (all fields are reported if empty)', verbose_name='changed fields'),
+        ),
+    ]
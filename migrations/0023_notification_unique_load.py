@@ -0,0 +1,31 @@
+# Generated by Django 5.2.18 on 2026-10-17 15:47
+
+from django.db import migrations, models
+
+
+def remove_duplicate_notifications(apps, schema_editor):
+    # Keep the earliest notification for each load
+    Notification = apps.get_model('ervinloads', 'Notification')
+    kept = set()
+    duplicates = []
+    for notification in Notification.objects.order_by('load_id', 'pk').values('pk', 'load_id'):
+        if notification['load_id'] in kept:
+            duplicates.append(notification['pk'])
+        else:
+            kept.add(notification['load_id'])
+    Notification.objects.filter(pk__in=duplicates).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ervinloads', '0022_notification_changed_fields'),
+    ]
+
+    operations = [
+        migrations.RunPython(remove_duplicate_notifications, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='notification',
+            constraint=models.UniqueConstraint(fields=('load',), name='ervinloads_notification_unique_load'),
+        ),
+    ]
@@ -0,0 +1,22 @@
+# Generated by Django 5.2.18 on 2026-10-17 15:52
+
+import django.db.models.functions.text
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ervinloads', '0023_notification_unique_load'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='location',
+            index=models.Index(django.db.models.functions.text.Upper('name'), name='ervinloads_location_uname_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='supplier',
+            index=models.Index(django.db.models.functions.text.Upper('name'), name='ervinloads_supplier_uname_idx'),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 5.2.18 on 2026-10-17 15:55
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ervinloads', '0024_name_search_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='load',
+            name='photo_preview',
+            field=models.ImageField(blank=True, editable=False, help_text='A screen sized copy of the photo for the detail page, made after the photo is uploaded', null=True, upload_to='ervinloads/thumbnails/%Y/%m/', verbose_name='photo preview'),
+        ),
+        migrations.AddField(
+            model_name='load',
+            name='photo_thumbnail',
+            field=models.ImageField(blank=True, editable=False, help_text='A small copy of the photo for lists, made after the photo is uploaded', null=True, upload_to='ervinloads/thumbnails/%Y/%m/', verbose_name='photo thumbnail'),
+        ),
+        migrations.AlterField(
+            model_name='load',
+            name='photo',
+            field=models.ImageField(blank=True, help_text='A photo of the load', null=True, upload_to='ervinloads/photos/%Y/%m/', verbose_name='photo'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-17 15:56
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ervinloads', '0025_load_photo_thumbnails'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='load',
+            name='photo_original_size',
+            field=models.PositiveBigIntegerField(blank=True, editable=False, help_text='The size in bytes of the photo as it was uploaded, before it was downscaled', null=True, verbose_name='photo original size'),
+        ),
+    ]
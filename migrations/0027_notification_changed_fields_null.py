@@ -0,0 +1,30 @@
+# Generated by Django 5.2.18 on 2026-10-17 16:14
+
+from django.db import migrations, models
+
+
+def empty_to_null(apps, schema_editor):
+    # An empty list used to mean the whole load is reported, which is now null
+    Notification = apps.get_model('ervinloads', 'Notification')
+    Notification.objects.filter(changed_fields=[]).update(changed_fields=None)
+
+
+def null_to_empty(apps, schema_editor):
+    Notification = apps.get_model('ervinloads', 'Notification')
+    Notification.objects.filter(changed_fields__isnull=True).update(changed_fields=[])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ervinloads', '0026_load_photo_original_size'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='notification',
+            name='changed_fields',
+            field=models.JSONField(blank=True, default=None, help_text='The load fields changed by the updates this notification reports (all fields are reported if null)', null=True, verbose_name='changed fields'),
+        ),
+        migrations.RunPython(empty_to_null, null_to_empty),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-17 16:15
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ervinloads', '0027_notification_changed_fields_null'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='notification',
+            name='delivered_to',
+            field=models.JSONField(blank=True, default=list, help_text='The recipients whose digest of this notification was sent, so a retry only sends to the others', verbose_name='delivered to'),
+        ),
+    ]
@@ -1,5 +1,9 @@
+import re
 from django.db import models
 from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.core.validators import validate_email
+from django.db.models.functions import Upper
 from datetime import datetime
 
 class Location(models.Model):
@@ -14,6 +18,9 @@ class Location(models.Model):
     )
     class Meta:
         ordering=('-is_default', 'name',)
+        indexes = [
+            models.Index(Upper('name'), name='ervinloads_location_uname_idx'),
+        ]
 
     def __str__(self):
         return self.name
@@ -32,6 +39,9 @@ class Supplier(models.Model):
 
     class Meta:
         ordering = ('name',)
+        indexes = [
+            models.Index(Upper('name'), name='ervinloads_supplier_uname_idx'),
+        ]
 
     def __str__(self):
         return self.name
@@ -90,6 +100,21 @@ class DeliveryStatus(models.Model):
     def __str__(self):
         return self.name
 
+def parse_email_addresses(email_addresses):
+    # Returns (valid, invalid) lists of normalized addresses without duplicates
+    valid = []
+    invalid = []
+    # dict.fromkeys drops the duplicates in one pass and keeps the order
+    emails = dict.fromkeys(email.strip().lower() for email in re.split(r",|;", email_addresses))
+    emails.pop('', None)
+    for email in emails:
+        try:
+            validate_email(email)
+            valid.append(email)
+        except ValidationError:
+            invalid.append(email)
+    return valid, invalid
+
 class NotificationGroup(models.Model):
     name = models.CharField(
         'name',
@@ -106,6 +131,12 @@ class NotificationGroup(models.Model):
         default = False,
         help_text = 'If this is a default notification group for new loads'
     )
+    recipients = models.JSONField(
+        'recipients',
+        default=list,
+        editable=False,
+        help_text = 'The valid, normalized addresses from email addresses'
+    )
 
     class Meta:
         ordering=('-is_default', 'name')
@@ -113,6 +144,18 @@ class NotificationGroup(models.Model):
     def __str__(self):
         return self.name
 
+    def clean(self):
+        valid, invalid = parse_email_addresses(self.email_addresses)
+        if invalid:
+            raise ValidationError({'email_addresses': f'Invalid email addresses: { ", ".join(invalid) }'})
+
+    def save(self, *args, **kwargs):
+        self.recipients = parse_email_addresses(self.email_addresses)[0]
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None and 'email_addresses' in update_fields:
+            kwargs['update_fields'] = {*update_fields, 'recipients'}
+        super().save(*args, **kwargs)
+
 class LoadsNotDeletedManager(models.Manager):
     def get_queryset(self):
         return super().get_queryset().filter(deleted_when__isnull=True)
@@ -190,10 +233,34 @@ class Load(models.Model):
     )
     photo = models.ImageField(
         'photo',
+        upload_to='ervinloads/photos/%Y/%m/',
         blank=True,
         null=True,
         help_text = 'A photo of the load'
     )
+    photo_original_size = models.PositiveBigIntegerField(
+        'photo original size',
+        blank=True,
+        null=True,
+        editable=False,
+        help_text = 'The size in bytes of the photo as it was uploaded, before it was downscaled'
+    )
+    photo_thumbnail = models.ImageField(
+        'photo thumbnail',
+        upload_to='ervinloads/thumbnails/%Y/%m/',
+        blank=True,
+        null=True,
+        editable=False,
+        help_text = 'A small copy of the photo for lists, made after the photo is uploaded'
+    )
+    photo_preview = models.ImageField(
+        'photo preview',
+        upload_to='ervinloads/thumbnails/%Y/%m/',
+        blank=True,
+        null=True,
+        editable=False,
+        help_text = 'A screen sized copy of the photo for the detail page, made after the photo is uploaded'
+    )
     notification_groups = models.ManyToManyField(
         NotificationGroup,
         blank = True,
@@ -214,6 +281,13 @@ class Load(models.Model):
 
     class Meta:
         ordering = ('updated_when',)
+        indexes = [
+            models.Index(fields=['updated_when'], condition=models.Q(deleted_when__isnull=True), name='ervinloads_load_active_upd_idx'),
+            models.Index(fields=['delivery_status', 'updated_when'], name='ervinloads_load_dstatus_idx'),
+            models.Index(fields=['completion_status', 'updated_when'], name='ervinloads_load_cstatus_idx'),
+            models.Index(fields=['po_number'], name='ervinloads_load_po_idx'),
+            models.Index(fields=['spo_number'], name='ervinloads_load_spo_idx'),
+        ]
 
     def __str__(self):
         return f'{ self.po_number } - { self.job_name }'
@@ -245,6 +319,18 @@ class LoadHistory(models.Model):
         ordering=('-changed_when',)
 
 class Notification(models.Model):
+    STATUS_PENDING = 'pending'
+    STATUS_QUEUED = 'queued'
+    STATUS_FAILED = 'failed'
+    STATUS_CHOICES = [
+        (STATUS_PENDING, 'Pending'),
+        (STATUS_QUEUED, 'Queued for delivery'),
+        (STATUS_FAILED, 'Failed'),
+    ]
+    # notifications that are waiting for someone to send them from the queue page,
+    # with queued ones that are overdue (see notifications.review_filter)
+    REVIEW_STATUSES = [STATUS_PENDING, STATUS_FAILED]
+
     load = models.ForeignKey(
         Load,
         on_delete = models.CASCADE,
@@ -262,5 +348,60 @@ class Notification(models.Model):
         null=True,
         help_text = 'The date this notification was created'
     )
+    status = models.CharField(
+        'status',
+        max_length=20,
+        choices=STATUS_CHOICES,
+        default=STATUS_PENDING,
+        db_index=True,
+        help_text = 'Pending notifications wait in the queue, queued notifications are delivered in the background'
+    )
+    attempts = models.PositiveIntegerField(
+        'attempts',
+        default=0,
+        help_text = 'The number of times delivery has been attempted'
+    )
+    next_attempt_at = models.DateTimeField(
+        'next attempt at',
+        blank=True,
+        null=True,
+        help_text = 'When delivery should next be attempted'
+    )
+    last_error = models.TextField(
+        'last error',
+        blank=True,
+        help_text = 'The error from the last failed delivery attempt'
+    )
+    changed_fields = models.JSONField(
+        'changed fields',
+        default=None,
+        blank=True,
+        null=True,
+        help_text = 'The load fields changed by the updates this notification reports (all fields are reported if null)'
+    )
+    delivered_to = models.JSONField(
+        'delivered to',
+        default=list,
+        blank=True,
+        help_text = 'The recipients whose digest of this notification was sent, so a retry only sends to the others'
+    )
+    leased_until = models.DateTimeField(
+        'leased until',
+        blank=True,
+        null=True,
+        help_text = 'When the worker delivering this notification gives up its claim on it'
+    )
+    lease_token = models.CharField(
+        'lease token',
+        max_length=32,
+        blank=True,
+        db_index=True,
+        help_text = 'Identifies the worker claim on this notification'
+    )
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['load'], name='ervinloads_notification_unique_load'),
+        ]
 
 #eof
@@ -0,0 +1,460 @@
+import functools
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from django.conf import settings
+from django.contrib import messages
+from django.core.mail import EmailMultiAlternatives
+from django.db import close_old_connections, connections, transaction
+from django.db.models import Q
+from django.template.loader import get_template
+from django.urls import reverse
+
+from .caching import bump_version, get_version
+from .conf import get_setting
+from .delivery import DeliveryPool
+from .models import Load, Notification
+
+
+def get_mail_from():
+    return settings.ERVINSUFFOLK_FROM_EMAIL if hasattr(
+        settings, 'ERVINSUFFOLK_FROM_EMAIL') else settings.DEFAULT_FROM_EMAIL
+
+def get_load_url(load, base_url):
+    return base_url.rstrip('/') + reverse('ervinloads:load-detail', kwargs={'pk': load.pk})
+
+def get_base_url(request=None):
+    if request is not None:
+        return request.build_absolute_uri('/')
+    return get_setting('BASE_URL', '')
+
+def resolve_recipients(loads):
+    # Maps each load's pk to the set of addresses of its notification groups,
+    # using one query for the whole batch
+    recipients = {load.pk: set() for load in loads}
+    through = Load.notification_groups.through
+    for load_id, group_recipients in through.objects.filter(load_id__in=recipients.keys()).values_list('load_id', 'notificationgroup__recipients'):
+        recipients[load_id].update(group_recipients or [])
+    return recipients
+
+def notification_recipients(load):
+    return sorted(resolve_recipients([load])[load.pk])
+
+# related objects the notification templates display
+NOTIFICATION_RELATED = [
+    'load',
+    'load__supplier',
+    'load__location',
+    'load__delivery_status',
+    'load__completion_status',
+]
+
+# the load fields reported in a notification, in order
+NOTIFICATION_FIELDS = [
+    ('job_name', 'Job Name'),
+    ('po_number', 'PO Number'),
+    ('supplier', 'Supplier'),
+    ('spo_number', 'Supplier PO Number'),
+    ('description', 'Description'),
+    ('location', 'Location'),
+    ('delivery_status', 'Delivery Status'),
+    ('completion_status', 'Completion Status'),
+    ('notes', 'Notes'),
+]
+
+def notification_fields(notification):
+    # (label, value) pairs of the fields to report, which are the changed
+    # fields unless changed_fields is None, meaning all of them
+    fields = []
+    for field_name, label in NOTIFICATION_FIELDS:
+        if notification.changed_fields is not None and not field_name in notification.changed_fields:
+            continue
+        fields.append((label, getattr(notification.load, field_name)))
+    return fields
+
+@functools.lru_cache(maxsize=None)
+def get_notification_templates():
+    return (
+        get_template('ervinloads/notification_email.txt'),
+        get_template('ervinloads/notification_email.html'),
+    )
+
+def render_notifications(notifications, base_url):
+    # Returns the plain and html bodies for a list of notifications whose
+    # loads have been fetched with NOTIFICATION_RELATED
+    text_template, html_template = get_notification_templates()
+    context = {
+        'items': [
+            {
+                'notification': notification,
+                'load': notification.load,
+                'fields': notification_fields(notification),
+                'url': get_load_url(notification.load, base_url),
+            }
+            for notification in notifications
+        ]
+    }
+    return text_template.render(context), html_template.render(context)
+
+def notification_subject(notification):
+    return f"Load { notification.action }: {notification.load.po_number} - { notification.load.job_name }"
+
+def notification_mail(notification, base_url, recipients=None, connection=None):
+    return digest_mail(
+        recipients if recipients is not None else notification_recipients(notification.load),
+        [notification],
+        base_url,
+        connection
+    )
+
+def digest_mail(recipients, notifications, base_url, connection=None):
+
+    if len(notifications) == 1:
+        mail_subject = notification_subject(notifications[0])
+    else:
+        mail_subject = f"{ len(notifications) } Load Notifications"
+
+    mail_message, mail_html_message = render_notifications(notifications, base_url)
+
+    mail = EmailMultiAlternatives(
+        mail_subject,
+        mail_message,
+        get_mail_from(),
+        recipients,
+        connection=connection,
+    )
+    mail.attach_alternative(mail_html_message, 'text/html')
+    return mail
+
+def notification_digests(notifications, base_url):
+    # Returns (message, notifications) for each recipient, the message covering
+    # only the loads that recipient is notified about and hasn't yet been sent
+
+    recipients = resolve_recipients([notification.load for notification in notifications])
+
+    notifications_by_recipient = {}
+    for notification in notifications:
+        for email in sorted(recipients[notification.load.pk] - set(notification.delivered_to)):
+            notifications_by_recipient.setdefault(email, []).append(notification)
+
+    return [
+        (digest_mail([recipient], recipient_notifications, base_url), recipient_notifications)
+        for recipient, recipient_notifications in notifications_by_recipient.items()
+    ]
+
+def send_digests(notifications, base_url, pool=None):
+    # Sends the digests through the delivery pool. Returns the notifications
+    # whose digests were all sent, and a dict of the errors for the others by
+    # pk. The recipients that were sent to are added to each notification's
+    # delivered_to, for save_delivered_to to keep when others failed
+
+    digests = notification_digests(notifications, base_url)
+    results = (pool or DeliveryPool()).send([mail for mail, digest_notifications in digests])
+
+    failures = {}
+    for result, (mail, digest_notifications) in zip(results, digests):
+        for notification in digest_notifications:
+            if result.sent:
+                notification.delivered_to = notification.delivered_to + mail.to
+            else:
+                failures.setdefault(notification.pk, result.error)
+
+    return [notification for notification in notifications if not notification.pk in failures], failures
+
+def report_send_errors(request, errors):
+    if errors:
+        messages.add_message(request, messages.WARNING, 'There was an error sending emails.')
+        for error in {str(error) for error in errors}:
+            messages.add_message(request, messages.WARNING, error)
+
+
+# Outbox delivery
+#
+# Notifications marked as queued are delivered outside of the request that
+# created them, either by the in-process executor below or by the
+# drain_notifications command. A worker first claims a batch by writing a lease
+# token to it, so that several workers never send the same notification. A
+# successful delivery deletes the notification. A failed one is retried with
+# exponential backoff until ERVINLOADS_NOTIFICATION_MAX_ATTEMPTS, after which it
+# is marked failed and left in the queue page to be sent by hand
+
+_executor = None
+_executor_lock = threading.Lock()
+
+def get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=get_setting('NOTIFICATION_WORKERS', 2),
+                thread_name_prefix='ervinloads-notifications'
+            )
+    return _executor
+
+def get_retry_delay(attempts):
+    return timedelta(seconds=get_setting('NOTIFICATION_RETRY_DELAY', 60) * 2 ** (attempts - 1))
+
+def lease_free(now):
+    return Q(leased_until__isnull=True) | Q(leased_until__lt=now)
+
+def claim_notifications(batch_size, lease_seconds=None, pks=None, condition=None):
+    # Leases up to batch_size due notifications (all of them if batch_size is
+    # None) that are queued, or that match condition, and returns them
+
+    now = datetime.now()
+    lease_seconds = lease_seconds or get_setting('NOTIFICATION_LEASE', 300)
+    token = uuid.uuid4().hex
+
+    claimable = Notification.objects.filter(
+        lease_free(now),
+        Q(next_attempt_at__isnull=True) | Q(next_attempt_at__lte=now),
+        condition if condition is not None else Q(status=Notification.STATUS_QUEUED),
+    )
+    if pks is not None:
+        claimable = claimable.filter(pk__in=pks)
+
+    with transaction.atomic(using=claimable.db):
+        candidates = claimable.order_by('next_attempt_at', 'pk')
+        if connections[claimable.db].features.has_select_for_update_skip_locked:
+            candidates = candidates.select_for_update(skip_locked=True)
+        candidate_pks = list(candidates.values_list('pk', flat=True)[:batch_size])
+
+        # Rows that can't be locked (SQLite) are still only claimed once because
+        # the update re-checks that the lease is free
+        claimable.filter(pk__in=candidate_pks).update(
+            leased_until=now + timedelta(seconds=lease_seconds),
+            lease_token=token
+        )
+
+    return list(Notification.objects.select_related(*NOTIFICATION_RELATED).filter(lease_token=token).order_by('pk'))
+
+def review_filter(now=None):
+    # The notifications shown in the queue page: pending and failed ones, and
+    # queued ones still unsent a lease after they were due, as when the process
+    # that was to deliver them stopped, so that none can be lost from sight
+    now = now or datetime.now()
+    overdue = now - timedelta(seconds=get_setting('NOTIFICATION_LEASE', 300))
+    return Q(status__in=Notification.REVIEW_STATUSES) | Q(
+        lease_free(now),
+        status=Notification.STATUS_QUEUED,
+        next_attempt_at__lt=overdue,
+    )
+
+def notification_count_tag():
+    # The notifications version and the current lease period, so the queue
+    # count also changes as queued notifications become overdue
+    period = int(time.time() // get_setting('NOTIFICATION_LEASE', 300))
+    return f'{ get_version("notifications") }.{ period }'
+
+def release_notifications(notifications):
+    Notification.objects.filter(
+        pk__in=[notification.pk for notification in notifications],
+        lease_token__in={notification.lease_token for notification in notifications}
+    ).update(leased_until=None, lease_token='')
+
+def send_and_delete_notifications(request, notifications, delete_all=False):
+    # Sends the notifications chosen in the queue page and deletes the ones that
+    # were sent. They are claimed first, so two people submitting the queue at
+    # once can't both send them. With delete_all the whole queue is claimed, and
+    # the claimed notifications that weren't sent are deleted as well; one that
+    # is updated meanwhile loses its claim, so the update is kept. Returns the
+    # number sent
+
+    pks = {notification.pk for notification in notifications}
+    if delete_all:
+        claimed = claim_notifications(None, condition=review_filter())
+    else:
+        claimed = claim_notifications(len(pks), pks=pks, condition=review_filter())
+    if not claimed:
+        return 0
+
+    # Whatever isn't sent or deleted is released, even if sending raises, so it
+    # can be sent or deleted from the queue page again straight away
+    try:
+        selected = [notification for notification in claimed if notification.pk in pks]
+        sent, failures = send_digests(selected, get_base_url(request)) if selected else ([], {})
+        report_send_errors(request, failures.values())
+        for notification in selected:
+            if notification.pk in failures:
+                save_delivered_to(notification)
+        sent_count = delete_delivered(sent)
+        if delete_all:
+            delete_delivered(claimed)
+        return sent_count
+    finally:
+        release_notifications(claimed)
+
+def delete_notifications(notifications):
+    # Deletes notifications from the queue page without sending them, apart
+    # from ones another sender has claimed
+    return Notification.objects.filter(
+        lease_free(datetime.now()),
+        pk__in=[notification.pk for notification in notifications]
+    ).delete()[1].get(Notification._meta.label, 0)
+
+def delete_delivered(notifications):
+    # Deletes sent notifications that haven't been updated since they were claimed
+    if not notifications:
+        return 0
+    return Notification.objects.filter(
+        pk__in=[notification.pk for notification in notifications],
+        lease_token__in={notification.lease_token for notification in notifications}
+    ).delete()[1].get(Notification._meta.label, 0)
+
+def save_delivered_to(notification):
+    Notification.objects.filter(pk=notification.pk, lease_token=notification.lease_token).update(
+        delivered_to=notification.delivered_to
+    )
+
+def record_delivery_failure(notification, error):
+    lease_token = notification.lease_token
+    notification.attempts = notification.attempts + 1
+    notification.last_error = str(error)
+    if notification.attempts >= get_setting('NOTIFICATION_MAX_ATTEMPTS', 5):
+        notification.status = Notification.STATUS_FAILED
+        notification.next_attempt_at = None
+    else:
+        notification.next_attempt_at = datetime.now() + get_retry_delay(notification.attempts)
+    notification.leased_until = None
+    notification.lease_token = ''
+    Notification.objects.filter(pk=notification.pk, lease_token=lease_token).update(
+        attempts=notification.attempts,
+        last_error=notification.last_error,
+        status=notification.status,
+        next_attempt_at=notification.next_attempt_at,
+        delivered_to=notification.delivered_to,
+        leased_until=None,
+        lease_token=''
+    )
+    bump_version('notifications')
+
+def deliver_notifications(notifications, base_url, pool=None):
+    # Delivers claimed notifications, one message each. Returns the number
+    # sent (and deleted)
+
+    results = (pool or DeliveryPool()).send([notification_mail(notification, base_url) for notification in notifications])
+
+    sent = []
+    for notification, result in zip(notifications, results):
+        if result.sent:
+            sent.append(notification)
+        else:
+            record_delivery_failure(notification, result.error)
+
+    return delete_delivered(sent)
+
+def deliver_notification(notification, base_url):
+    return deliver_notifications([notification], base_url) == 1
+
+def deliver_digests(notifications, base_url, pool=None):
+    # Delivers claimed notifications as per-recipient digests. Returns the
+    # number of notifications sent (and deleted)
+
+    sent, failures = send_digests(notifications, base_url, pool)
+
+    for notification in notifications:
+        if notification.pk in failures:
+            record_delivery_failure(notification, failures[notification.pk])
+
+    return delete_delivered(sent)
+
+def deliver_queued_notification(pk, base_url):
+    try:
+        for notification in claim_notifications(1, pks=[pk]):
+            if not deliver_notification(notification, base_url) and notification.status == Notification.STATUS_QUEUED:
+                delay = (notification.next_attempt_at - datetime.now()).total_seconds()
+                timer = threading.Timer(max(delay, 0), submit_notification, args=(pk, base_url))
+                timer.daemon = True
+                timer.start()
+    finally:
+        close_old_connections()
+
+def submit_notification(pk, base_url):
+    get_executor().submit(deliver_queued_notification, pk, base_url)
+
+def schedule_notification(pk, base_url, delay):
+    if delay > 0:
+        timer = threading.Timer(delay, submit_notification, args=(pk, base_url))
+        timer.daemon = True
+        timer.start()
+    else:
+        submit_notification(pk, base_url)
+
+def merge_changed_fields(changed_fields, new_changed_fields):
+    # None means the whole load is reported
+    if changed_fields is None or new_changed_fields is None:
+        return None
+    return changed_fields + [field for field in new_changed_fields if not field in changed_fields]
+
+def record_load_notification(load, action, changed_fields, send_now, base_url):
+    # Records a Created or Updated notification for a load. changed_fields is
+    # None to report the whole load, or the fields that were changed, and no
+    # notification is recorded if none of them are reported. A load has at most
+    # one notification, so updates are merged into the one that is waiting,
+    # which keeps the list of changed fields, and written with a single upsert.
+    # With send_now, delivery can be set to wait
+    # ERVINLOADS_NOTIFICATION_COALESCE_MINUTES so that further updates in that
+    # window are sent along with it. By default it is sent straight away
+
+    now = datetime.now()
+    window = timedelta(minutes=get_setting('NOTIFICATION_COALESCE_MINUTES', 0))
+    if changed_fields is not None:
+        changed_fields = [field_name for field_name, label in NOTIFICATION_FIELDS if field_name in changed_fields]
+        if not changed_fields:
+            return None
+
+    with transaction.atomic():
+        # Locking the load makes concurrent saves of it wait here, so neither
+        # upsert is based on a read that the other makes stale
+        list(Load.all_objects.select_for_update().filter(pk=load.pk).values_list('pk'))
+
+        existing = Notification.objects.filter(load=load).values('action', 'changed_fields', 'status', 'next_attempt_at', 'attempts', 'lease_token').first()
+
+        notification = Notification(
+            load=load,
+            action=action,
+            changed_fields=changed_fields,
+            status=Notification.STATUS_QUEUED if send_now else Notification.STATUS_PENDING,
+            next_attempt_at=now + window if send_now else None,
+            created_when=now.date(),
+        )
+
+        if existing is not None:
+            if 'Created' in existing['action'] and action != 'Created':
+                notification.action = 'Created and Updated'
+            notification.changed_fields = merge_changed_fields(existing['changed_fields'], changed_fields)
+            if existing['status'] == Notification.STATUS_QUEUED:
+                # Keep the delivery time unless the notification is already being
+                # sent, in which case it is sent again with these changes
+                notification.status = Notification.STATUS_QUEUED
+                if not existing['lease_token'] and existing['next_attempt_at'] and existing['next_attempt_at'] > now:
+                    notification.next_attempt_at = existing['next_attempt_at']
+                else:
+                    notification.next_attempt_at = now + window
+                notification.attempts = existing['attempts']
+
+        # Clearing the lease means a worker that is sending the old version of this
+        # notification won't delete it afterwards, and clearing delivered_to
+        # means every recipient is sent the new version
+        Notification.objects.bulk_create(
+            [notification],
+            update_conflicts=True,
+            unique_fields=['load'] if connections[Notification.objects.db].features.supports_update_conflicts_with_target else None,
+            update_fields=['action', 'changed_fields', 'status', 'next_attempt_at', 'attempts', 'last_error', 'delivered_to', 'leased_until', 'lease_token'],
+        )
+
+    # The upsert doesn't send post_save, so the count version is bumped here
+    transaction.on_commit(lambda: bump_version('notifications'))
+
+    schedule = notification.status == Notification.STATUS_QUEUED and (
+        existing is None or existing['status'] != Notification.STATUS_QUEUED or notification.next_attempt_at != existing['next_attempt_at']
+    )
+    if schedule and get_setting('NOTIFICATION_DELIVER_IN_PROCESS', True):
+        if notification.pk is None:
+            notification.pk = Notification.objects.values_list('pk', flat=True).get(load=load)
+        delay = (notification.next_attempt_at - now).total_seconds()
+        transaction.on_commit(lambda: schedule_notification(notification.pk, base_url, delay))
+
+    return notification
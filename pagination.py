@@ -0,0 +1,177 @@
+import base64
+import json
+from datetime import datetime
+from django.core.exceptions import FieldDoesNotExist, ValidationError
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import Q
+
+from .conf import get_setting
+
+
+def keyset_pagination_enabled():
+    return get_setting('KEYSET_PAGINATION', False)
+
+
+def get_keyset_ordering(queryset):
+    # Returns a list of (attname, descending) ending with the primary key, or
+    # None if the ordering can't be used as a key (nullable or related fields)
+
+    model = queryset.model
+    ordering = list(queryset.query.order_by) or list(model._meta.ordering)
+
+    keys = []
+    for item in ordering:
+        if not isinstance(item, str):
+            return None
+        name = item.lstrip('-')
+        if name == '?' or '__' in name:
+            return None
+        if name == 'pk':
+            name = model._meta.pk.name
+        try:
+            field = model._meta.get_field(name)
+        except FieldDoesNotExist:
+            return None
+        if field.is_relation or field.null:
+            return None
+        keys.append((field.attname, item.startswith('-')))
+        if field.primary_key:
+            return keys
+
+    keys.append((model._meta.pk.attname, False))
+    return keys
+
+
+def encode_value(value):
+    # DjangoJSONEncoder drops microseconds below a millisecond, which would
+    # make the cursor fall between rows, so datetimes keep full precision
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return value
+
+
+def encode_cursor(obj, keys):
+    # The cursor carries the keys it was made for, so one kept in a url after
+    # the list's ordering changes is ignored rather than applied to other fields
+    cursor = {
+        'keys': [[attname, descending] for attname, descending in keys],
+        'values': [encode_value(getattr(obj, attname)) for attname, descending in keys],
+    }
+    return base64.urlsafe_b64encode(json.dumps(cursor, cls=DjangoJSONEncoder).encode()).decode()
+
+
+def decode_cursor(cursor, keys, model):
+    # Returns the cursor's values converted by their fields, or None for a
+    # cursor that is invalid or was made for other keys, which shows the first page
+    try:
+        cursor = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        if cursor['keys'] != [[attname, descending] for attname, descending in keys]:
+            return None
+        if not isinstance(cursor['values'], list) or len(cursor['values']) != len(keys):
+            return None
+        fields = {field.attname: field for field in model._meta.concrete_fields}
+        values = [fields[attname].to_python(value) for (attname, descending), value in zip(keys, cursor['values'])]
+    except (ValueError, KeyError, TypeError, ValidationError):
+        return None
+    if None in values:
+        return None
+    return values
+
+
+def keyset_filter(keys, values, forward=True):
+    # (a > 1) or (a = 1 and b > 2) or (a = 1 and b = 2 and pk > 3) ...
+    condition = Q()
+    for index, (attname, descending) in enumerate(keys):
+        lookup = 'lt' if descending == forward else 'gt'
+        term = Q(**{f'{attname}__{lookup}': values[index]})
+        for previous_index, (previous_attname, previous_descending) in enumerate(keys[:index]):
+            term &= Q(**{previous_attname: values[previous_index]})
+        condition |= term
+    return condition
+
+
+def keyset_order_by(keys, forward=True):
+    return [('-' if descending == forward else '') + attname for attname, descending in keys]
+
+
+class KeysetPage:
+    is_keyset = True
+    number = None
+    paginator = None
+
+    def __init__(self, object_list, keys, has_next, has_previous):
+        self.object_list = object_list
+        self.keys = keys
+        self._has_next = has_next
+        self._has_previous = has_previous
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def has_next(self):
+        return self._has_next
+
+    def has_previous(self):
+        return self._has_previous
+
+    def has_other_pages(self):
+        return self._has_next or self._has_previous
+
+    def next_cursor(self):
+        if self.object_list:
+            return encode_cursor(self.object_list[-1], self.keys)
+        return ''
+
+    def previous_cursor(self):
+        if self.object_list:
+            return encode_cursor(self.object_list[0], self.keys)
+        return ''
+
+
+def paginate_keyset(queryset, keys, page_size, after=None, before=None, last=False):
+
+    if after is not None:
+        rows = list(queryset.filter(keyset_filter(keys, after)).order_by(*keyset_order_by(keys))[:page_size + 1])
+        return KeysetPage(rows[:page_size], keys, len(rows) > page_size, True)
+
+    if before is not None or last:
+        reversed_queryset = queryset.order_by(*keyset_order_by(keys, forward=False))
+        if before is not None:
+            reversed_queryset = reversed_queryset.filter(keyset_filter(keys, before, forward=False))
+        rows = list(reversed_queryset[:page_size + 1])
+        has_previous = len(rows) > page_size
+        rows = rows[:page_size]
+        rows.reverse()
+        return KeysetPage(rows, keys, before is not None, has_previous)
+
+    rows = list(queryset.order_by(*keyset_order_by(keys))[:page_size + 1])
+    return KeysetPage(rows[:page_size], keys, len(rows) > page_size, False)
+
+
+class KeysetPaginationMixin:
+    # Replaces OFFSET paging with cursor paging on the list's ordering when
+    # ERVINLOADS_KEYSET_PAGINATION is set. Cursors are passed as ?after=,
+    # ?before= or ?last= so the frm_vista paging script can keep posting them
+
+    def paginate_queryset(self, queryset, page_size):
+
+        keys = get_keyset_ordering(queryset) if keyset_pagination_enabled() else None
+        if keys is None:
+            return super().paginate_queryset(queryset, page_size)
+
+        after = decode_cursor(self.request.GET['after'], keys, queryset.model) if self.request.GET.get('after') else None
+        before = decode_cursor(self.request.GET['before'], keys, queryset.model) if self.request.GET.get('before') else None
+
+        page = paginate_keyset(
+            queryset,
+            keys,
+            int(page_size),
+            after=after,
+            before=before,
+            last=bool(self.request.GET.get('last'))
+        )
+
+        return (None, page, page.object_list, page.has_other_pages())
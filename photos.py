@@ -0,0 +1,268 @@
+import hashlib
+import logging
+import mimetypes
+import multiprocessing
+import posixpath
+import re
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from urllib.parse import quote
+from django.core.files.base import ContentFile
+from django.db import close_old_connections, transaction
+from django.db.models import Q
+from django.http import FileResponse, HttpResponse, StreamingHttpResponse
+from django.utils.cache import get_conditional_response, quote_etag
+from django.utils.http import http_date
+from PIL import features
+
+from .caching import bump_version
+from .conf import get_setting
+from .imaging import downscale_photo, render_thumbnails
+from .models import Load
+
+logger = logging.getLogger(__name__)
+
+# Thumbnails kept for each photo, as field name: (file name suffix, setting
+# for its maximum width and height, default size)
+THUMBNAIL_FIELDS = {
+    'photo_thumbnail': ('thumb', 'PHOTO_THUMBNAIL_SIZE', 200),
+    'photo_preview': ('preview', 'PHOTO_PREVIEW_SIZE', 1000),
+}
+
+THUMBNAIL_EXTENSIONS = {'WEBP': 'webp', 'JPEG': 'jpg'}
+
+def get_thumbnail_format():
+    # WebP where Pillow supports it, otherwise JPEG
+    return get_setting('PHOTO_THUMBNAIL_FORMAT', 'WEBP' if features.check('webp') else 'JPEG')
+
+# Photos are read and saved on a thread, and decoded and resized in a process
+# pool of ERVINLOADS_PHOTO_WORKERS processes, so the request that uploaded the
+# photo doesn't wait for them
+
+_executor = None
+_process_pool = None
+_executor_lock = threading.Lock()
+
+def get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=get_setting('PHOTO_WORKERS', 2),
+                thread_name_prefix='ervinloads-photos'
+            )
+    return _executor
+
+def get_process_pool():
+    global _process_pool
+    with _executor_lock:
+        if _process_pool is None:
+            # Forking a threaded server would copy its locks and connections
+            # into the workers, so they start from a clean interpreter
+            start_method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+            _process_pool = ProcessPoolExecutor(
+                max_workers=get_setting('PHOTO_WORKERS', 2),
+                mp_context=multiprocessing.get_context(start_method)
+            )
+    return _process_pool
+
+def run_in_process_pool(fn, *args):
+    # A worker that dies, as when an image runs it out of memory, breaks the
+    # whole pool, so a broken pool is replaced and the job tried once more
+    global _process_pool
+    for attempt in range(2):
+        pool = get_process_pool()
+        try:
+            return pool.submit(fn, *args).result()
+        except BrokenProcessPool:
+            with _executor_lock:
+                if _process_pool is pool:
+                    _process_pool = None
+            pool.shutdown(wait=False)
+            if attempt:
+                raise
+
+def process_upload(photo):
+    # Downscales and recompresses an uploaded photo in the process pool, to at
+    # most ERVINLOADS_PHOTO_MAX_SIZE pixels wide and high at
+    # ERVINLOADS_PHOTO_QUALITY. Large uploads are already streamed to a
+    # temporary file, which the worker reads from instead of being sent the
+    # bytes. Returns the file to store, which is the upload itself if
+    # processing wouldn't make it smaller
+
+    if hasattr(photo, 'temporary_file_path'):
+        source = photo.temporary_file_path()
+    else:
+        photo.seek(0)
+        source = photo.read()
+
+    result = run_in_process_pool(
+        downscale_photo, source, get_setting('PHOTO_MAX_SIZE', 2560), get_setting('PHOTO_QUALITY', 85)
+    )
+    photo.seek(0)
+
+    if result is None:
+        return photo
+
+    data, image_format = result
+    stem = posixpath.splitext(posixpath.basename(photo.name))[0]
+    return ContentFile(data, name=f'{ stem }.{ "png" if image_format == "PNG" else "jpg" }')
+
+def thumbnail_name(photo_name, suffix, data, extension):
+    # The content hash makes the name change whenever the thumbnail does, so
+    # thumbnails can be cached by browsers indefinitely
+    stem = posixpath.splitext(posixpath.basename(photo_name))[0]
+    return f'{ stem }-{ suffix }-{ hashlib.md5(data).hexdigest()[:10] }.{ extension }'
+
+def photo_filter(name):
+    return Q(photo=name) | Q(photo__isnull=True) if not name else Q(photo=name)
+
+def generate_thumbnails(pk):
+    # Replaces the load's thumbnails with ones made from its current photo, or
+    # clears them if it has none. Nothing is saved if the photo changes while
+    # the thumbnails are made
+
+    load = Load.all_objects.filter(pk=pk).only('photo', *THUMBNAIL_FIELDS).first()
+    if load is None:
+        return
+
+    old_names = [getattr(load, field_name).name for field_name in THUMBNAIL_FIELDS if getattr(load, field_name)]
+    values = {field_name: None for field_name in THUMBNAIL_FIELDS}
+
+    if load.photo:
+        with load.photo.open('rb') as photo:
+            data = photo.read()
+
+        image_format = get_thumbnail_format()
+        sizes = [get_setting(setting, size) for suffix, setting, size in THUMBNAIL_FIELDS.values()]
+        thumbnails = run_in_process_pool(
+            render_thumbnails, data, sizes, image_format, get_setting('PHOTO_THUMBNAIL_QUALITY', 80)
+        )
+
+        for (field_name, (suffix, setting, size)), thumbnail in zip(THUMBNAIL_FIELDS.items(), thumbnails):
+            fieldfile = getattr(load, field_name)
+            name = thumbnail_name(load.photo.name, suffix, thumbnail, THUMBNAIL_EXTENSIONS[image_format])
+            if fieldfile.name != fieldfile.field.generate_filename(load, name):
+                fieldfile.save(name, ContentFile(thumbnail), save=False)
+            values[field_name] = fieldfile.name
+
+    new_names = [name for name in values.values() if name]
+    if Load.all_objects.filter(photo_filter(load.photo.name), pk=pk).update(**values):
+        stale_names = [name for name in old_names if not name in new_names]
+        bump_version(f'load_row:{ pk }')
+    else:
+        stale_names = new_names
+
+    for name in stale_names:
+        load.photo_thumbnail.storage.delete(name)
+
+def run_thumbnails(pk):
+    try:
+        generate_thumbnails(pk)
+    except Exception:
+        logger.exception('Thumbnails for load %s could not be made', pk)
+    finally:
+        close_old_connections()
+
+def schedule_thumbnails(load):
+    # Called when a load's photo has been changed or cleared
+    pk = load.pk
+    transaction.on_commit(lambda: get_executor().submit(run_thumbnails, pk))
+
+# Serving photos. The view checks permission and then either hands the file to
+# the web server, when ERVINLOADS_PHOTO_SENDFILE is 'X-Sendfile' (Apache,
+# lighttpd) or 'X-Accel-Redirect' (nginx, with the storage location mapped to
+# ERVINLOADS_PHOTO_ACCEL_PREFIX as an internal location), or streams it itself
+
+RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+def get_range(request, etag, size):
+    # Returns (start, end) for a single satisfiable byte range, None for a full
+    # response, or False if the range can't be satisfied
+    match = RANGE_RE.match(request.META.get('HTTP_RANGE', '').strip())
+    if not match or not size:
+        return None
+    if_range = request.META.get('HTTP_IF_RANGE')
+    if if_range and if_range != etag:
+        return None
+    first, last = match.groups()
+    if not first and not last:
+        return None
+    if not first:
+        start = max(size - int(last), 0)
+        end = size - 1
+    else:
+        start = int(first)
+        end = min(int(last), size - 1) if last else size - 1
+    if start >= size or start > end:
+        return False
+    return start, end
+
+def read_range(photo, start, end, chunk_size=65536):
+    with photo.open('rb') as file:
+        file.seek(start)
+        remaining = end - start + 1
+        while remaining > 0:
+            chunk = file.read(min(chunk_size, remaining))
+            if not chunk:
+                break
+            remaining = remaining - len(chunk)
+            yield chunk
+
+def photo_response(request, photo, immutable=False):
+
+    try:
+        size = photo.size
+    except FileNotFoundError:
+        return None
+
+    try:
+        last_modified = int(photo.storage.get_modified_time(photo.name).timestamp())
+    except (NotImplementedError, FileNotFoundError):
+        last_modified = None
+
+    etag = quote_etag(hashlib.md5(f'{ photo.name }:{ size }:{ last_modified }'.encode()).hexdigest())
+    content_type = mimetypes.guess_type(photo.name)[0] or 'application/octet-stream'
+
+    response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+    if response is None:
+        response = sendfile_response(photo, content_type)
+    if response is None:
+        byte_range = get_range(request, etag, size)
+        if byte_range is False:
+            response = HttpResponse(status=416)
+            response['Content-Range'] = f'bytes */{ size }'
+        elif byte_range:
+            start, end = byte_range
+            response = StreamingHttpResponse(read_range(photo, start, end), status=206, content_type=content_type)
+            response['Content-Range'] = f'bytes { start }-{ end }/{ size }'
+            response['Content-Length'] = end - start + 1
+        else:
+            response = FileResponse(photo.open('rb'), content_type=content_type)
+        response['Accept-Ranges'] = 'bytes'
+
+    response['ETag'] = etag
+    if last_modified is not None:
+        response['Last-Modified'] = http_date(last_modified)
+    # A url naming the current file with ?v= can be cached for good
+    response['Cache-Control'] = 'private, max-age=31536000, immutable' if immutable else 'private, no-cache'
+    return response
+
+def sendfile_response(photo, content_type):
+    sendfile = get_setting('PHOTO_SENDFILE', None)
+    if sendfile == 'X-Accel-Redirect':
+        response = HttpResponse(content_type=content_type)
+        # Upload names may hold spaces and non-ASCII characters, which a header
+        # can't carry as is
+        response['X-Accel-Redirect'] = quote(get_setting('PHOTO_ACCEL_PREFIX', '/protected/') + photo.name)
+        return response
+    if sendfile == 'X-Sendfile':
+        try:
+            path = photo.path
+        except NotImplementedError:
+            return None
+        response = HttpResponse(content_type=content_type)
+        response['X-Sendfile'] = quote(path)
+        return response
+    return None
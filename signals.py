@@ -0,0 +1,36 @@
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .caching import LOOKUP_MODELS, REFERENCE_FIELDS, bump_version, lookup_version_name
+from .models import CompletionStatus, DeliveryStatus, Load, Location, Notification, Supplier
+
+# Models whose changes can alter the counts of a list vista. Loads are soft
+# deleted with a save, so post_save covers deletion from the lists as well
+COUNTED_MODELS = [Load, Location, Supplier, DeliveryStatus, CompletionStatus]
+
+@receiver(post_save)
+@receiver(post_delete)
+def invalidate_counts(sender, **kwargs):
+    if sender in COUNTED_MODELS:
+        bump_version('counts')
+
+@receiver(post_save, sender=Notification)
+@receiver(post_delete, sender=Notification)
+def invalidate_notification_count(sender, **kwargs):
+    bump_version('notifications')
+
+@receiver(post_save)
+@receiver(post_delete)
+def invalidate_reference_data(sender, **kwargs):
+    if sender in REFERENCE_FIELDS:
+        bump_version('reference')
+    if sender in LOOKUP_MODELS:
+        bump_version(lookup_version_name(sender))
+        # A new row doesn't change the names already shown in load rows
+        if not kwargs.get('created'):
+            bump_version('lookup_names')
+
+@receiver(post_save, sender=Load)
+@receiver(post_delete, sender=Load)
+def invalidate_load_row(sender, instance, **kwargs):
+    bump_version(f'load_row:{ instance.pk }')
@@ -0,0 +1,71 @@
+// Adds a search box after each select with a data-autocomplete-url. Choosing a
+// result replaces the select's options with that one choice
+
+function autocompleteSelect(select) {
+  let url = select.dataset.autocompleteUrl
+  let search = document.createElement('input')
+  search.type = 'search'
+  search.placeholder = 'Search'
+  search.setAttribute('autocomplete', 'off')
+  let results = document.createElement('ul')
+  results.className = 'autocomplete-results'
+  results.style.display = 'none'
+  select.after(search, results)
+
+  let timer = null
+  let controller = null
+
+  function choose(result) {
+    for (let option of Array.from(select.options)) {
+      if (option.value != '') {
+        option.remove()
+      }
+    }
+    select.add(new Option(result.text, result.id, true, true))
+    select.dispatchEvent(new Event('change', {bubbles: true}))
+    search.value = ''
+    results.style.display = 'none'
+  }
+
+  function show(data) {
+    results.replaceChildren()
+    for (let result of data.results) {
+      let item = document.createElement('li')
+      item.textContent = result.text
+      item.addEventListener('mousedown', function(e) {
+        e.preventDefault()
+        choose(result)
+      })
+      results.append(item)
+    }
+    results.style.display = data.results.length ? 'block' : 'none'
+  }
+
+  search.addEventListener('input', function() {
+    clearTimeout(timer)
+    if (search.value.trim() == '') {
+      results.style.display = 'none'
+      return
+    }
+    timer = setTimeout(function() {
+      if (controller) {
+        controller.abort()
+      }
+      controller = new AbortController()
+      fetch(url + '?' + new URLSearchParams({q: search.value.trim()}), {signal: controller.signal})
+        .then(function(response) { return response.json() })
+        .then(show)
+        .catch(function() {})
+    }, 200)
+  })
+
+  search.addEventListener('blur', function() {
+    results.style.display = 'none'
+  })
+}
+
+document.addEventListener('DOMContentLoaded', function() {
+  for (let select of document.querySelectorAll('select[data-autocomplete-url]')) {
+    autocompleteSelect(select)
+  }
+})
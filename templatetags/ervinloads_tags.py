@@ -0,0 +1,56 @@
+from functools import lru_cache
+from django import template
+
+register = template.Library()
+
+# The load list columns in display order, as (column name, cell template)
+LOAD_LIST_COLUMNS = [
+    ('job_name', '{{ load.job_name }}'),
+    ('po_number', '{{ load.po_number }}'),
+    ('supplier', '{{ load.supplier }}'),
+    ('spo_number', '{{ load.spo_number }}'),
+    ('description', '{{ load.description }}'),
+    ('notes', '{{ load.notes }}'),
+    ('location', '{{ load.location }}'),
+    ('delivery_status', '{{ load.delivery_status }}'),
+    ('created_when', '{{ load.created_when }}'),
+    ('updated_when', '{{ load.updated_when }}'),
+    ('do_install', '{{ load.get_do_install_display }}'),
+    ('photo', '{% if load.photo_thumbnail %}<img src="{% url \'ervinloads:load-photo\' load.pk %}?size=thumbnail&amp;v={{ load.photo_thumbnail.name|urlencode }}" alt="{{ load.photo }}" loading="lazy">{% else %}{{ load.photo }}{% endif %}'),
+    ('completion_status', '{{ load.completion_status }}'),
+]
+
+def load_list_columns(show_columns):
+    return tuple(column for column in LOAD_LIST_COLUMNS if column[0] in show_columns or not show_columns)
+
+@lru_cache(maxsize=64)
+def load_row_template(engine, columns):
+    # One template per set of shown columns, so a row is rendered without an
+    # include or a column test for each cell
+    source = '<div class="row">\n'
+    source += '  <div class="listfield"><a href="{% url \'ervinloads:load-detail\' load.pk %}">view</a></div>\n'
+    for name, cell in columns:
+        source += f'  <div class="field column">\n    { cell }\n  </div>\n'
+    source += '</div>\n'
+    return engine.from_string(source)
+
+@lru_cache(maxsize=64)
+def load_head_template(engine, columns):
+    source = '<div class="row rowhead">\n'
+    source += '  <div class="field">\n    \n  </div>\n'
+    for name, cell in columns:
+        source += f'  <div class="field">\n    {{{{ labels.{ name } }}}}\n  </div>\n'
+    source += '</div>\n'
+    return engine.from_string(source)
+
+@register.simple_tag(takes_context=True)
+def load_list_row(context, load, show_columns):
+    row_template = load_row_template(context.template.engine, load_list_columns(show_columns))
+    with context.push(load=load):
+        return row_template.render(context)
+
+@register.simple_tag(takes_context=True)
+def load_list_head(context, labels, show_columns):
+    head_template = load_head_template(context.template.engine, load_list_columns(show_columns))
+    with context.push(labels=labels):
+        return head_template.render(context)
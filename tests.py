@@ -1,3 +1,324 @@
-from django.test import TestCase
+import base64
+import io
+import json
+from datetime import datetime, timedelta
+from smtplib import SMTPException
+from types import SimpleNamespace
+from unittest import mock, skipIf
+from django.contrib.messages.storage.cookie import CookieStorage
+from django.core import mail
+from django.core.mail.backends.base import BaseEmailBackend
+from django.test import RequestFactory, TestCase, override_settings
 
-# Create your tests here.
+from .caching import cached_autocomplete, cached_count, get_version, reference_row
+from .exporting import csv_lines, export_columns, export_rows, openpyxl, xlsx_response
+from .merging import merge_locations
+from .models import Load, Location, Notification, NotificationGroup, Supplier, parse_email_addresses
+from .notifications import (claim_notifications, delete_notifications, deliver_digests, record_load_notification, review_filter,
+                            send_and_delete_notifications)
+from .pagination import decode_cursor, encode_cursor, get_keyset_ordering, paginate_keyset
+from .photos import sendfile_response
+from .templatetags.ervinloads_tags import LOAD_LIST_COLUMNS
+
+
+class KeysetCursorTests(TestCase):
+
+    def setUp(self):
+        start = datetime(2024, 1, 1, 12, 0, 0, 1)
+        for index in range(5):
+            Load.objects.create(job_name=f'j{ index }', po_number=str(index), updated_when=start + timedelta(microseconds=index * 3))
+
+    def page_through(self, queryset, page_size):
+        keys = get_keyset_ordering(queryset)
+        pages = []
+        after = None
+        for attempt in range(10):
+            page = paginate_keyset(queryset, keys, page_size, after=after)
+            pages.append([load.job_name for load in page])
+            if not page.has_next():
+                return pages
+            after = decode_cursor(page.next_cursor(), keys, Load)
+        return pages
+
+    def test_cursor_round_trip_keeps_microseconds(self):
+        queryset = Load.objects.order_by('updated_when')
+        keys = get_keyset_ordering(queryset)
+        load = queryset[1]
+        self.assertEqual(decode_cursor(encode_cursor(load, keys), keys, Load), [load.updated_when, load.pk])
+
+    def test_ascending_pages_do_not_repeat_rows(self):
+        self.assertEqual(self.page_through(Load.objects.order_by('updated_when'), 3), [['j0', 'j1', 'j2'], ['j3', 'j4']])
+
+    def test_descending_pages_do_not_skip_rows(self):
+        self.assertEqual(self.page_through(Load.objects.order_by('-updated_when'), 2), [['j4', 'j3'], ['j2', 'j1'], ['j0']])
+
+    def test_invalid_cursor_is_ignored(self):
+        keys = get_keyset_ordering(Load.objects.order_by('updated_when'))
+        self.assertIsNone(decode_cursor('not a cursor', keys, Load))
+
+    def test_cursor_with_values_of_the_wrong_type_is_ignored(self):
+        keys = get_keyset_ordering(Load.objects.order_by('-updated_when'))
+        cursor = base64.urlsafe_b64encode(json.dumps({'keys': [list(key) for key in keys], 'values': ['abc', 'x']}).encode()).decode()
+        self.assertIsNone(decode_cursor(cursor, keys, Load))
+
+    def test_cursor_for_another_ordering_is_ignored(self):
+        load = Load.objects.order_by('updated_when')[1]
+        cursor = encode_cursor(load, get_keyset_ordering(Load.objects.order_by('updated_when')))
+        self.assertIsNone(decode_cursor(cursor, get_keyset_ordering(Load.objects.order_by('-updated_when')), Load))
+        self.assertIsNone(decode_cursor(cursor, get_keyset_ordering(Load.objects.order_by('job_name')), Load))
+
+
+class CachedCountTests(TestCase):
+
+    def test_count_is_cached_until_a_load_changes(self):
+        Load.objects.create(job_name='a', po_number='1')
+        queryset = Load.objects.filter(po_number__startswith='1')
+        self.assertEqual(cached_count(queryset), 1)
+
+        Load.objects.filter(pk__isnull=False).update(po_number='10')
+        with self.assertNumQueries(0):
+            self.assertEqual(cached_count(queryset), 1)
+
+        version = get_version('counts')
+        Load.objects.create(job_name='b', po_number='11')
+        self.assertEqual(get_version('counts'), version + 1)
+        self.assertEqual(cached_count(queryset), 2)
+
+
+class ParseEmailAddressesTests(TestCase):
+
+    def test_addresses_are_normalized_and_deduplicated_in_order(self):
+        self.assertEqual(
+            parse_email_addresses(' B@example.com; a@example.com, b@example.com,,bad; BAD '),
+            (['b@example.com', 'a@example.com'], ['bad'])
+        )
+
+
+class ReferenceDataTests(TestCase):
+
+    def test_deleted_row_is_dropped_from_the_index(self):
+        location = Location.objects.create(name='Yard')
+        self.assertEqual(reference_row(Location, location.pk)['name'], 'Yard')
+        location.delete()
+        self.assertIsNone(reference_row(Location, location.pk))
+
+
+class CachedAutocompleteTests(TestCase):
+
+    def test_names_starting_with_the_term_come_first_in_any_case(self):
+        for name in ['Zack', 'acorn', 'Acme', 'Beta']:
+            Supplier.objects.create(name=name)
+        results = cached_autocomplete(Supplier.objects.all(), 'aC', 10)
+        self.assertEqual([row['text'] for row in results], ['Acme', 'acorn', 'Zack'])
+
+    def test_new_supplier_refreshes_its_autocomplete_only(self):
+        self.assertEqual(cached_autocomplete(Supplier.objects.all(), 'ne', 10), [])
+        versions = get_version('reference'), get_version('lookup_names')
+        supplier = Supplier.objects.create(name='New')
+        self.assertEqual(cached_autocomplete(Supplier.objects.all(), 'ne', 10), [{'id': supplier.pk, 'text': 'New'}])
+        self.assertEqual((get_version('reference'), get_version('lookup_names')), versions)
+
+
+class SendfileResponseTests(TestCase):
+    photo = SimpleNamespace(name='photos/big photo é.jpg', path='/srv/media/photos/big photo é.jpg')
+
+    @override_settings(ERVINLOADS_PHOTO_SENDFILE='X-Accel-Redirect')
+    def test_accel_redirect_path_is_url_encoded(self):
+        response = sendfile_response(self.photo, 'image/jpeg')
+        self.assertEqual(response['X-Accel-Redirect'], '/protected/photos/big%20photo%20%C3%A9.jpg')
+
+    @override_settings(ERVINLOADS_PHOTO_SENDFILE='X-Sendfile')
+    def test_sendfile_path_is_url_encoded(self):
+        response = sendfile_response(self.photo, 'image/jpeg')
+        self.assertEqual(response['X-Sendfile'], '/srv/media/photos/big%20photo%20%C3%A9.jpg')
+
+
+class ExportTests(TestCase):
+
+    def test_every_list_column_is_exported(self):
+        columns = export_columns([])
+        self.assertEqual(columns, [column for column, cell in LOAD_LIST_COLUMNS])
+        load = Load.objects.create(job_name='j', po_number='1', supplier=Supplier.objects.create(name='Acme'))
+        row = dict(zip(columns, next(export_rows(Load.objects.all(), columns))))
+        self.assertEqual((row['supplier'], row['location'], row['photo']), ('Acme', '', ''))
+        self.assertEqual(row['do_install'], load.get_do_install_display())
+
+    def test_formula_values_are_written_as_text(self):
+        Load.objects.create(job_name='=HYPERLINK("http://example.com")', po_number='-1', notes='a=b')
+        lines = list(csv_lines(Load.objects.all(), ['job_name', 'po_number', 'notes'], {}))
+        self.assertEqual(lines[1], '"\'=HYPERLINK(""http://example.com"")",\'-1,a=b\r\n')
+
+    @skipIf(openpyxl is None, 'openpyxl is not installed')
+    def test_xlsx_keeps_formula_like_values_as_text(self):
+        Load.objects.create(job_name='=SUM(1)', po_number='-5', notes='+1 555 1234')
+        response = xlsx_response(Load.objects.all(), ['job_name', 'po_number', 'notes'], {})
+        worksheet = openpyxl.load_workbook(io.BytesIO(b''.join(response.streaming_content))).active
+        cells = list(worksheet.iter_rows(min_row=2))[0]
+        self.assertEqual([(cell.value, cell.data_type) for cell in cells], [('=SUM(1)', 's'), ('-5', 's'), ('+1 555 1234', 's')])
+
+
+class MergeLocationsTests(TestCase):
+
+    def test_loads_are_moved_and_the_move_is_recorded(self):
+        target, first, second = [Location.objects.create(name=name) for name in ['Yard', 'Shed', 'Barn']]
+        loads = [Load.objects.create(job_name=f'j{ index }', po_number=str(index), location=location) for index, location in enumerate([first, second, target])]
+
+        with mock.patch('ervinloads.merging.update_history') as update_history:
+            self.assertEqual(merge_locations([first, second, target], target), {'loads': 2, 'locations': 2})
+
+        self.assertEqual(Load.all_objects.filter(location=target).count(), 3)
+        self.assertEqual(list(Location.objects.values_list('name', flat=True)), ['Yard'])
+        recorded = {call.args[3].pk: call.args[0] for call in update_history.call_args_list}
+        self.assertEqual(sorted(recorded), [loads[0].pk, loads[1].pk])
+        for form in recorded.values():
+            self.assertEqual(form.changed_data, ['location'])
+            self.assertEqual(form.cleaned_data['location'], target)
+
+
+class FailingEmailBackend(BaseEmailBackend):
+
+    def send_messages(self, email_messages):
+        raise SMTPException('mail server is down')
+
+
+class FailingForOneEmailBackend(BaseEmailBackend):
+    failing = {'two@example.com'}
+
+    def send_messages(self, email_messages):
+        for message in email_messages:
+            if self.failing & set(message.to):
+                raise SMTPException('mailbox unavailable')
+            mail.outbox.append(message)
+        return len(email_messages)
+
+
+class NotificationTestCase(TestCase):
+
+    def setUp(self):
+        self.group = NotificationGroup.objects.create(name='group', email_addresses='one@example.com')
+        self.loads = []
+        for index in range(3):
+            load = Load.objects.create(job_name=f'j{ index }', po_number=str(index))
+            load.notification_groups.add(self.group)
+            self.loads.append(load)
+
+    def make_request(self):
+        request = RequestFactory().post('/')
+        request._messages = CookieStorage(request)
+        return request
+
+
+class SendAndDeleteTests(NotificationTestCase):
+
+    def setUp(self):
+        super().setUp()
+        for load in self.loads:
+            Notification.objects.create(load=load, action='Created', created_when=datetime.now().date())
+
+    def test_sent_notifications_are_deleted(self):
+        self.assertEqual(send_and_delete_notifications(self.make_request(), list(Notification.objects.all())), 3)
+        self.assertFalse(Notification.objects.exists())
+        self.assertEqual(len(mail.outbox), 1)
+
+    @override_settings(EMAIL_BACKEND='ervinloads.tests.FailingEmailBackend')
+    def test_failed_send_releases_the_lease(self):
+        self.assertEqual(send_and_delete_notifications(self.make_request(), list(Notification.objects.all())), 0)
+        self.assertEqual(Notification.objects.filter(lease_token='', leased_until__isnull=True).count(), 3)
+
+    def test_error_after_claim_releases_the_lease(self):
+        with mock.patch('ervinloads.notifications.get_base_url', side_effect=RuntimeError):
+            with self.assertRaises(RuntimeError):
+                send_and_delete_notifications(self.make_request(), list(Notification.objects.all()))
+        self.assertEqual(Notification.objects.filter(lease_token='', leased_until__isnull=True).count(), 3)
+
+
+    def test_delete_all_keeps_a_notification_updated_while_sending(self):
+        selected = list(Notification.objects.filter(load=self.loads[0]))
+
+        def send_digests(notifications, base_url):
+            record_load_notification(self.loads[1], 'Updated', ['job_name'], False, base_url)
+            return notifications, {}
+
+        with mock.patch('ervinloads.notifications.send_digests', side_effect=send_digests):
+            self.assertEqual(send_and_delete_notifications(self.make_request(), selected, delete_all=True), 1)
+        notification = Notification.objects.get()
+        self.assertEqual(notification.load, self.loads[1])
+        self.assertEqual(notification.lease_token, '')
+
+    def test_delete_without_sending_skips_claimed_notifications(self):
+        claim_notifications(1, pks=[Notification.objects.get(load=self.loads[0]).pk], condition=review_filter())
+        self.assertEqual(delete_notifications(list(Notification.objects.all())), 2)
+        self.assertEqual(Notification.objects.get().load, self.loads[0])
+
+
+class RecordLoadNotificationTests(NotificationTestCase):
+
+    def record(self, load, action, changed_fields, send_now=False):
+        return record_load_notification(load, action, changed_fields, send_now, 'http://testserver/')
+
+    def test_changes_to_unreported_fields_are_not_recorded(self):
+        self.assertIsNone(self.record(self.loads[0], 'Updated', ['updated_when', 'photo']))
+        self.assertFalse(Notification.objects.exists())
+
+    def test_no_op_update_does_not_widen_a_waiting_notification(self):
+        self.record(self.loads[0], 'Updated', ['job_name', 'updated_when'])
+        self.record(self.loads[0], 'Updated', [])
+        self.assertEqual(Notification.objects.get().changed_fields, ['job_name'])
+
+    def test_changed_fields_are_merged_and_none_means_all(self):
+        self.record(self.loads[0], 'Updated', ['job_name'])
+        self.record(self.loads[0], 'Updated', ['notes', 'po_number'])
+        self.assertEqual(Notification.objects.get().changed_fields, ['job_name', 'po_number', 'notes'])
+
+        self.record(self.loads[1], 'Created', None)
+        self.record(self.loads[1], 'Updated', ['job_name'])
+        notification = Notification.objects.get(load=self.loads[1])
+        self.assertIsNone(notification.changed_fields)
+        self.assertEqual(notification.action, 'Created and Updated')
+
+    @override_settings(ERVINLOADS_NOTIFICATION_DELIVER_IN_PROCESS=False)
+    def test_send_now_is_due_straight_away(self):
+        notification = self.record(self.loads[0], 'Created', None, send_now=True)
+        self.assertEqual(notification.status, Notification.STATUS_QUEUED)
+        self.assertLessEqual(notification.next_attempt_at, datetime.now())
+
+    def test_overdue_queued_notifications_are_shown_for_review(self):
+        now = datetime.now()
+        Notification.objects.create(load=self.loads[0], action='Created', status=Notification.STATUS_QUEUED, next_attempt_at=now - timedelta(hours=1))
+        Notification.objects.create(load=self.loads[1], action='Created', status=Notification.STATUS_QUEUED, next_attempt_at=now)
+        Notification.objects.create(load=self.loads[2], action='Created')
+        self.assertEqual(
+            sorted(Notification.objects.filter(review_filter()).values_list('load__job_name', flat=True)),
+            ['j0', 'j2']
+        )
+
+    def test_upsert_bumps_the_notification_version(self):
+        version = get_version('notifications')
+        with self.captureOnCommitCallbacks(execute=True):
+            self.record(self.loads[0], 'Created', None)
+        self.assertEqual(get_version('notifications'), version + 1)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.record(self.loads[0], 'Updated', ['job_name'])
+        self.assertEqual(get_version('notifications'), version + 2)
+        self.assertEqual(Notification.objects.count(), 1)
+
+
+class DeliverDigestsTests(NotificationTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.group.email_addresses = 'one@example.com, two@example.com'
+        self.group.save()
+        Notification.objects.create(load=self.loads[0], action='Created', status=Notification.STATUS_QUEUED, created_when=datetime.now().date())
+
+    def test_retry_only_sends_to_failed_recipients(self):
+        with override_settings(EMAIL_BACKEND='ervinloads.tests.FailingForOneEmailBackend'):
+            self.assertEqual(deliver_digests(claim_notifications(10), 'http://testserver/'), 0)
+        notification = Notification.objects.get()
+        self.assertEqual(notification.delivered_to, ['one@example.com'])
+        self.assertEqual([message.to for message in mail.outbox], [['one@example.com']])
+
+        Notification.objects.update(next_attempt_at=None)
+        self.assertEqual(deliver_digests(claim_notifications(10), 'http://testserver/'), 1)
+        self.assertEqual([message.to for message in mail.outbox], [['one@example.com'], ['two@example.com']])
+        self.assertFalse(Notification.objects.exists())
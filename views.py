@@ -1,16 +1,20 @@
+import asyncio
 import re
 import sys
+import time
 import urllib
 from urllib.parse import urlencode
 from datetime import datetime
-from django.conf import settings
+from asgiref.sync import sync_to_async
 from django.contrib import messages
 from django.contrib.auth.mixins import PermissionRequiredMixin
-from django.core.exceptions import FieldError, ObjectDoesNotExist
-from django.http import Http404, QueryDict
+from django.core.exceptions import FieldError, ObjectDoesNotExist, PermissionDenied
+from django.core.paginator import Paginator
+from django.http import Http404, JsonResponse, QueryDict
 from django.http.response import HttpResponse, HttpResponseRedirect
 from django.shortcuts import redirect, render
 from django.urls import reverse, reverse_lazy
+from django.utils.cache import get_conditional_response, patch_cache_control, quote_etag
 from django.views.generic.detail import DetailView
 from django.views.generic.edit import (CreateView, DeleteView, FormView,
                                        UpdateView)
@@ -20,169 +24,51 @@ from tougshire_vistas.views import (default_vista, delete_vista,
                                     get_global_vista, get_latest_vista,
                                     make_vista, make_vista_fields,
                                     retrieve_vista, vista_context_data)
-from django.core.mail import send_mail
+from .conf import get_setting
+from .exporting import export_formats, export_response
 from .forms import (LoadForm, LocationForm, LocationMergeForm, NotificationForm, NotificationSendForm, SupplierForm)
 from .models import (CompletionStatus, Load, Location, Notification, NotificationGroup, DeliveryStatus, Supplier,)
+from .caching import (CachedCountPaginator, cached_autocomplete, cached_count, cached_notification_count,
+                      default_pk, default_pks, get_cache_timeout, row_cache_key, set_row_versions)
+from .merging import merge_locations
+from .notifications import delete_notifications, get_base_url, notification_count_tag, record_load_notification, review_filter, send_and_delete_notifications
+from .pagination import KeysetPaginationMixin
+from .photos import photo_response, schedule_thumbnails
 
 from tougshire_history.views import update_history
 from tougshire_history.models import History
-from django.contrib.auth.decorators import permission_required
-
-def send_notification(request, notification):
-    emails = []
-    load = notification.load
-    notification_groups = load.notification_groups.all()
-    for notification_group in notification_groups:
-        emails_in_group = re.split( r",|;", notification_group.email_addresses)
-        for email in emails_in_group:
-            email = email.strip()
-            if email > '' and not email in emails:
-                emails.append(email)
-
-    load_url = request.build_absolute_uri(
-        reverse('ervinloads:load-detail', kwargs={'pk': load.pk}))
-
-    mail_subject = f"Load { notification.action }: {load.po_number} - { load.job_name }"
-
-    mail_from = settings.ERVINSUFFOLK_FROM_EMAIL if hasattr(
-        settings, 'ERVINSUFFOLK_FROM_EMAIL') else settings.DEFAULT_FROM_EMAIL
-
-    mail_message = "\n".join(
-        [
-            f"The following load was { notification.action }",
-            "",
-            f"Job Name: { load.job_name }",
-            f"PO Numner: { load.po_number }" ,
-            f"Supplier: {load.supplier }",
-            f"Supplier PO Number: { load.spo_number }",
-            f"Description: { load.description }",
-            f"Location: { load.location.name }",
-            f"Delivery Status: { load.delivery_status.name }",
-            f"Completion Status: { load.completion_status.name }",
-            f"Notes: { load.notes }",
-            f"URL: { load_url }",
-        ]
-    )
-
-    mail_html_message = "<br>\n".join(
-        [
-            f"The following load was { notification.action }",
-            "",
-            f"Job Name: { load.job_name }",
-            f"PO Number: { load.po_number }",
-            f"Supplier: {load.supplier }",
-            f"Supplier PO Number: { load.spo_number }",
-            f"Description: { load.description }",
-            f"Location: { load.location.name }",
-            f"Delivery Status: { load.delivery_status.name }",
-            f"Completion Status: { load.completion_status.name }",
-            f"Notes: { load.notes }",
-            f"URL: <a href=\"{ load_url }\">{ load_url }</a>"
-        ]
-    )
-
-    mail_recipients = emails
-
-    try:
-        send_mail(
-            mail_subject,
-            mail_message,
-            mail_from,
-            mail_recipients,
-            html_message=mail_html_message,
-            fail_silently=False,
-        )
-    except Exception as e:
-        messages.add_message(request, messages.WARNING, 'There was an error sending emails.')
-        messages.add_message(request, messages.WARNING, e)
-
-        print(e, ' at ', sys.exc_info()[2].tb_lineno)
-
-        return e
-
-
-def send_notifications(request, notifications):
-    email_addresses = []
-
-    mail_from = settings.ERVINSUFFOLK_FROM_EMAIL if hasattr(
-        settings, 'ERVINSUFFOLK_FROM_EMAIL') else settings.DEFAULT_FROM_EMAIL
-
-    mail_subject = 'Notification'
-    mail_message=''
-    mail_html_message=''
-    
-    for notification in notifications:
-        load = notification.load
-        notification_groups = load.notification_groups.all()
-        for notification_group in notification_groups:
-            emails_in_group = re.split( r",|;", notification_group.email_addresses)
-            for email_address in emails_in_group:
-                email_address = email_address.strip()
-                if email_address > '' and not email_address in email_addresses:
-                    email_addresses.append(email_address)
-
-        mail_subject = mail_subject + f":: Load { notification.action }: {load.po_number} - { load.job_name }" 
-
-        load_url = request.build_absolute_uri(
-            reverse('ervinloads:load-detail', kwargs={'pk': load.pk}))
-
-
-        mail_message = mail_message + "\n".join(
-            [
-                f"The following load was { notification.action }",
-                "",
-                f"Job Name: { load.job_name }",
-                f"PO Numner: { load.po_number }" ,
-                f"Supplier: {load.supplier }",
-                f"Supplier PO Number: { load.spo_number }",
-                f"Description: { load.description }",
-                f"Location: { load.location.name }",
-                f"Delivery Status: { load.delivery_status.name }",
-                f"Completion Status: { load.completion_status.name }",
-                f"Notes: { load.notes }",
-                f"URL: { load_url }",
-                '------------------------------------',
-                '',
-            ]
-        )
-
-        mail_html_message = mail_html_message + "<br>\n".join(
-            [
-                f"The following load was { notification.action }",
-                "",
-                f"Job Name: { load.job_name }",
-                f"PO Number: { load.po_number }",
-                f"Supplier: {load.supplier }",
-                f"Supplier PO Number: { load.spo_number }",
-                f"Description: { load.description }",
-                f"Location: { load.location.name }",
-                f"Delivery Status: { load.delivery_status.name }",
-                f"Completion Status: { load.completion_status.name }",
-                f"Notes: { load.notes }",
-                f"URL: <a href=\"{ load_url }\">{ load_url }</a>",
-                '------------------------------------',
-                ''
-            ]
-        )
-
-    mail_recipients = email_addresses
-
-    try:
-        send_mail(
-            mail_subject,
-            mail_message,
-            mail_from,
-            mail_recipients,
-            html_message=mail_html_message,
-            fail_silently=False,
-        )
-    except Exception as e:
-        messages.add_message(request, messages.WARNING, 'There was an error sending emails.')
-        messages.add_message(request, messages.WARNING, e)
-
-        print(e, ' at ', sys.exc_info()[2].tb_lineno)
-
-        return e
+from django.contrib.auth.decorators import permission_required, user_passes_test
+
+# columns in the load list that are rendered through a foreign key, and the
+# related fields that are never displayed there
+LOAD_LIST_RELATED_COLUMNS = {
+    'supplier': ['supplier__details'],
+    'location': [],
+    'delivery_status': [],
+    'completion_status': [],
+}
+
+# large text columns that only need to be fetched when they are displayed
+LOAD_LIST_DEFERRABLE_COLUMNS = ['description', 'notes']
+
+def plan_load_queryset(queryset, show_columns):
+    # An empty show_columns means every column is displayed
+    related = []
+    deferred = []
+    for column, unused_fields in LOAD_LIST_RELATED_COLUMNS.items():
+        if column in show_columns or not show_columns:
+            related.append(column)
+            deferred = deferred + unused_fields
+    for column in LOAD_LIST_DEFERRABLE_COLUMNS:
+        if show_columns and not column in show_columns:
+            deferred.append(column)
+
+    if related:
+        queryset = queryset.select_related(*related)
+    if deferred:
+        queryset = queryset.defer(*deferred)
+
+    return queryset
 
 class LoadCreate(PermissionRequiredMixin, CreateView):
     permission_required = 'ervinloads.add_load'
@@ -192,10 +78,10 @@ class LoadCreate(PermissionRequiredMixin, CreateView):
     def get_initial(self):
 
         initial = super().get_initial()
-        initial['notification_groups'] = [group for group in NotificationGroup.objects.filter(is_default=True)]
-        initial['delivery_status'] = DeliveryStatus.objects.filter(is_default=True).first()
-        initial['completion_status'] = CompletionStatus.objects.filter(is_default=True).first()
-        initial['location'] = Location.objects.filter(is_default=True).first()
+        initial['notification_groups'] = default_pks(NotificationGroup)
+        initial['delivery_status'] = default_pk(DeliveryStatus)
+        initial['completion_status'] = default_pk(CompletionStatus)
+        initial['location'] = default_pk(Location)
 
         return initial
 
@@ -207,14 +93,10 @@ class LoadCreate(PermissionRequiredMixin, CreateView):
 
         self.object = form.save()
 
-        notification = Notification.objects.create(
-            load = self.object,
-            action = 'Created'
-        )
+        record_load_notification(self.object, 'Created', None, self.request.POST.get('send_now'), get_base_url(self.request))
 
-        if self.request.POST.get('send_now'):
-            send_notification(self.request, notification)
-            notification.delete()
+        if 'photo' in form.changed_data:
+            schedule_thumbnails(self.object)
 
         return response
 
@@ -243,19 +125,10 @@ class LoadUpdate(PermissionRequiredMixin, UpdateView):
 
         self.object = form.save()
 
-        notification, created = Notification.objects.get_or_create(
-            load = self.object
-        )
-        notification.save()
-        if created:
-            notification.action = "Updated"
-        else:
-            notification.action = "Created and Updated"
-        notification.save()
+        record_load_notification(self.object, 'Updated', form.changed_data, self.request.POST.get('send_now'), get_base_url(self.request))
 
-        if self.request.POST.get('send_now'):
-            send_notification(self.request, notification)
-            notification.delete()
+        if 'photo' in form.changed_data:
+            schedule_thumbnails(self.object)
 
         return response
 
@@ -295,10 +168,11 @@ class LoadSoftDelete(PermissionRequiredMixin, UpdateView):
 
         return context_data
 
-class LoadList(PermissionRequiredMixin, ListView):
+class LoadList(PermissionRequiredMixin, KeysetPaginationMixin, ListView):
     permission_required = 'ervinloads.view_load'
     model = Load
     paginate_by = 30
+    paginator_class = CachedCountPaginator
 
     def setup(self, request, *args, **kwargs):
 
@@ -339,9 +213,21 @@ class LoadList(PermissionRequiredMixin, ListView):
 
         return super().setup(request, *args, **kwargs)
 
-    def post(self, request, *args, **kwargs):
+    def get(self, request, *args, **kwargs):
+
+        # ?export=csv or ?export=xlsx downloads every load in the vista instead
+        # of showing a page
+        export_format = request.GET.get('export')
+        if export_format in export_formats():
+            self.object_list = self.get_queryset()
+            vista_data = vista_context_data(self.vista_settings, self.vistaobj['querydict'])
+            return export_response(self.object_list, vista_data.get('show_columns') or [], vista_data.get('labels'), export_format)
+
         return super().get(request, *args, **kwargs)
 
+    def post(self, request, *args, **kwargs):
+        return self.get(request, *args, **kwargs)
+
     def get_queryset(self, **kwargs):
 
         queryset = super().get_queryset()
@@ -405,8 +291,13 @@ class LoadList(PermissionRequiredMixin, ListView):
 
             print('tp 224bc53', 'else')
 
+        self.vistaobj['queryset'] = plan_load_queryset(self.vistaobj['queryset'], self.get_show_columns())
+
         return self.vistaobj['queryset']
 
+    def get_show_columns(self):
+        return vista_context_data(self.vista_settings, self.vistaobj['querydict']).get('show_columns') or []
+
     def get_paginate_by(self, queryset):
 
         if 'paginate_by' in self.vistaobj['querydict'] and self.vistaobj['querydict']['paginate_by']:
@@ -427,7 +318,13 @@ class LoadList(PermissionRequiredMixin, ListView):
         if self.request.POST.get('vista_name'):
             context_data['vista_name'] = self.request.POST.get('vista_name')
 
-        context_data['count'] = self.object_list.count()
+        context_data['count'] = cached_count(self.object_list)
+
+        set_row_versions(context_data['object_list'])
+        context_data['row_cache_key'] = row_cache_key(context_data.get('show_columns') or [])
+        context_data['row_cache_timeout'] = get_cache_timeout('row', 3600)
+
+        context_data['export_formats'] = export_formats()
 
         return context_data
 
@@ -505,7 +402,7 @@ class LocationMerge(PermissionRequiredMixin, FormView):
     def get_initial(self, **kwargs):
         initial_data = super().get_initial(**kwargs)
         print('tp 2253f05', self.kwargs.get('pk'))
-        initial_data['merge_from'] = self.kwargs.get('pk')
+        initial_data['merge_from'] = [self.kwargs.get('pk')]
         return initial_data
 
     def get_context_data(self, **kwargs):
@@ -515,8 +412,8 @@ class LocationMerge(PermissionRequiredMixin, FormView):
 
     def form_valid(self, form):
         try:
-            Load.objects.filter(location=form.cleaned_data['merge_from']).update(location=form.cleaned_data['merge_to'])
-            form.cleaned_data['merge_from'].delete()
+            result = merge_locations(form.cleaned_data['merge_from'], form.cleaned_data['merge_to'], self.request.user)
+            messages.add_message(self.request, messages.INFO, f'{ result["loads"] } loads moved from { result["locations"] } locations')
         except Exception as e:
             messages.add_message(self.request, messages.WARNING, 'This merge could not be completed' )
             messages.add_message(self.request, messages.WARNING, str(e) )
@@ -524,10 +421,11 @@ class LocationMerge(PermissionRequiredMixin, FormView):
 
         return super().form_valid(form)
 
-class LocationList(PermissionRequiredMixin, ListView):
+class LocationList(PermissionRequiredMixin, KeysetPaginationMixin, ListView):
     permission_required = 'ervinloads.view_location'
     model = Location
     paginate_by = 30
+    paginator_class = CachedCountPaginator
 
     def setup(self, request, *args, **kwargs):
 
@@ -634,7 +532,7 @@ class LocationList(PermissionRequiredMixin, ListView):
         if self.request.POST.get('vista_name'):
             context_data['vista_name'] = self.request.POST.get('vista_name')
 
-        context_data['count'] = self.object_list.count()
+        context_data['count'] = cached_count(self.object_list)
 
         return context_data
 
@@ -702,10 +600,11 @@ class SupplierDelete(PermissionRequiredMixin, DeleteView):
     model = Supplier
     success_url = reverse_lazy('ervinloads:supplier-list')
 
-class SupplierList(PermissionRequiredMixin, ListView):
+class SupplierList(PermissionRequiredMixin, KeysetPaginationMixin, ListView):
     permission_required = 'ervinloads.view_supplier'
     model = Supplier
     paginate_by = 30
+    paginator_class = CachedCountPaginator
 
     def setup(self, request, *args, **kwargs):
 
@@ -812,7 +711,7 @@ class SupplierList(PermissionRequiredMixin, ListView):
         if self.request.POST.get('vista_name'):
             context_data['vista_name'] = self.request.POST.get('vista_name')
 
-        context_data['count'] = self.object_list.count()
+        context_data['count'] = cached_count(self.object_list)
 
         return context_data
 
@@ -828,13 +727,21 @@ class NotificationQueue(PermissionRequiredMixin, FormView):
 
     form_class = NotificationSendForm
     template_name = 'ervinloads/notification_queue.html'
+    paginate_by = 100
 
     def get_success_url(self):
         return reverse('ervinloads:notification-queue')
 
     def get_context_data(self, **kwargs):
         context_data = super().get_context_data(**kwargs)
-        context_data['notifications'] = Notification.objects.all()
+
+        notifications = Notification.objects.filter(
+            review_filter()
+        ).select_related('load').prefetch_related('load__notification_groups').order_by('pk')
+
+        page_obj = Paginator(notifications, self.paginate_by).get_page(self.request.GET.get('page'))
+        context_data['page_obj'] = page_obj
+        context_data['notifications'] = page_obj.object_list
         return context_data
 
     def form_valid(self, form):
@@ -842,65 +749,83 @@ class NotificationQueue(PermissionRequiredMixin, FormView):
         response = super().form_valid(form)
 
         notifications = form.cleaned_data['notifications']
-        if( form.cleaned_data['operation'] == 'ss'):
-
-            try:
-                send_notifications(self.request, notifications )
-                for notification in notifications:
-                    notification.delete()
-            except Exception as e:
-                print(e)
-            
-        elif(form.cleaned_data['operation']) == 'sa':
-
-            try:
-                send_notification(self.request, notifications )
-
-            except Exception as e:
-                print(e)
-
-            for notification in Notification.objects.all():
-                notification.delete()
-
-        elif(form.cleaned_data['operation']) == 'ns':
-            for notification in notifications:
-                try:
-                    notification.delete()
-                except Exception as e:
-                    print(e)
-
-
-
-
-        # if( form.cleaned_data['operation'] == 'ss'):
-        #     for notification in form.cleaned_data['notifications']:
-        #         try:
-        #             send_notification(self.request, notification )
-        #             notification.delete()
-        #         except Exception as e:
-        #             print(e)
-
-        # elif(form.cleaned_data['operation']) == 'sa':
-        #     for notification in form.cleaned_data['notifications']:
-        #         try:
-        #             send_notification(self.request, notification )
-        #             notification.delete()
-        #         except Exception as e:
-        #             print(e)
-
-        #     for notification in Notification.objects.all():
-        #         if not notification in form.cleaned_data['notifications']:
-        #             notification.delete()
-
-        # elif(form.cleaned_data['operation']) == 'ns':
-        #     for notification in form.cleaned_data['notifications']:
-        #         try:
-        #             notification.delete()
-        #         except Exception as e:
-        #             print(e)
+        operation = form.cleaned_data['operation']
+
+        if operation in ('ss', 'sa'):
+            send_and_delete_notifications(self.request, notifications, delete_all=operation == 'sa')
+
+        elif operation == 'ns':
+            delete_notifications(notifications)
 
         return response
 
-def notification_count(request):
-    return HttpResponse(Notification.objects.count())
+async def notification_count(request):
+    # The count is served from the cache with notification_count_tag as its
+    # ETag, so browsers revalidate with a 304. When
+    # ERVINLOADS_NOTIFICATION_LONGPOLL is a number of seconds, a request with
+    # ?since=<tag> waits up to that long for the count to change. The view
+    # is async so that under ASGI a waiting request doesn't hold a worker; only
+    # enable long-polling when the site is served with ASGI
+
+    longpoll = get_setting('NOTIFICATION_LONGPOLL', 0)
+
+    if longpoll and request.GET.get('since'):
+        deadline = time.monotonic() + longpoll
+        while await sync_to_async(notification_count_tag)() == request.GET.get('since') and time.monotonic() < deadline:
+            await asyncio.sleep(1)
+
+    tag = await sync_to_async(notification_count_tag)()
+    count = await sync_to_async(cached_notification_count)(Notification.objects.filter(review_filter()), tag)
+
+    response = HttpResponse(count)
+    response['ETag'] = quote_etag(tag)
+    response['Cache-Control'] = 'private, no-cache'
+    if longpoll:
+        response['X-Long-Poll'] = longpoll
+
+    return get_conditional_response(request, etag=response['ETag'], response=response)
+
+def autocomplete_response(request, queryset):
+    # Returns {"results": [{"id": pk, "text": name}, ...]} for ?q=, limited to
+    # ERVINLOADS_AUTOCOMPLETE_LIMIT results
+
+    limit = get_setting('AUTOCOMPLETE_LIMIT', 20)
+
+    term = request.GET.get('q', '').strip()[:80]
+
+    response = JsonResponse({'results': cached_autocomplete(queryset, term, limit)})
+    patch_cache_control(response, private=True, max_age=60)
+    return response
+
+def can_edit_loads(user):
+    # The autocomplete fills the load form's selects, so anyone who can add or
+    # change a load can use it
+    if user.has_perm('ervinloads.add_load') or user.has_perm('ervinloads.change_load'):
+        return True
+    raise PermissionDenied
+
+@user_passes_test(can_edit_loads)
+def supplier_autocomplete(request):
+    return autocomplete_response(request, Supplier.objects.all())
+
+@user_passes_test(can_edit_loads)
+def location_autocomplete(request):
+    return autocomplete_response(request, Location.objects.all())
+
+# The load photo fields that can be requested with ?size=
+LOAD_PHOTO_SIZES = {'': 'photo', 'thumbnail': 'photo_thumbnail', 'preview': 'photo_preview'}
+
+@permission_required('ervinloads.view_load', raise_exception=True)
+def load_photo(request, pk):
+
+    field_name = LOAD_PHOTO_SIZES.get(request.GET.get('size', ''))
+    load = Load.objects.filter(pk=pk).only(field_name).first() if field_name else None
+    photo = getattr(load, field_name) if load else None
+    if not photo:
+        raise Http404
+
+    response = photo_response(request, photo, immutable=request.GET.get('v') == photo.name)
+    if response is None:
+        raise Http404
 
+    return response